@@ -1,14 +1,23 @@
+import sys
 import random
 import time
+import threading
 import configparser
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from src.emby import Emby
+from src.rate_limiter import RateLimiter
 from src.item_sorting import ItemSorting
 from src.refresher import Refresher
 from src.mdblist import Mdblist
 from src.date_parser import inside_period
 from src.db import Db
-from src.utils import find_missing_entries_in_list
+from src.provider_index import ProviderIndex
+from src.property_ledger import PropertyLedger
+from src.poster_cache import PosterCache
+from src.list_output import ListOutput
+from src.quota_planner import QuotaPlanner
+from src.collection_diff import diff_collection
 from src.utils import minutes_until_2100
 
 config_parser = configparser.ConfigParser()
@@ -43,84 +52,177 @@ refresh_items_max_days_since_added = config_parser.getint(
 refresh_items_max_days_since_premiered = config_parser.getint(
     "admin", "refresh_items_in_collections_max_days_since_premiered", fallback=30
 )
+refresh_items_show_rating_change = config_parser.getboolean(
+    "admin", "refresh_items_in_collections_show_rating_change", fallback=False
+)
+refresh_items_hours_between_refreshes = config_parser.getint(
+    "admin", "refresh_items_in_collections_hours_between_refreshes", fallback=24
+)
+refresh_items_max_per_cycle = config_parser.getint(
+    "admin", "refresh_items_in_collections_max_per_cycle", fallback=100
+)
+refresh_items_profile = config_parser.get(
+    "admin", "refresh_items_in_collections_profile", fallback="metadata_only"
+)
+if refresh_items_profile not in Emby.refresh_profiles:
+    print(
+        f"Unknown refresh_items_in_collections_profile {refresh_items_profile}, using metadata_only. Must be one of: {', '.join(Emby.refresh_profiles)}"
+    )
+    refresh_items_profile = "metadata_only"
+refresh_items_workers = config_parser.getint(
+    "admin", "refresh_items_in_collections_workers", fallback=2
+)
 use_mdblist_collection_description = config_parser.getboolean(
     "admin", "use_mdblist_collection_description", fallback=False
 )
 
 hours_between_refresh = config_parser.getint("admin", "hours_between_refresh")
 
+emby_connection_pool_size = config_parser.getint(
+    "admin", "emby_connection_pool_size", fallback=10
+)
+emby_request_timeout = config_parser.getint(
+    "admin", "emby_request_timeout", fallback=30
+)
+emby_max_retries = config_parser.getint("admin", "emby_max_retries", fallback=3)
+emby_keep_alive = config_parser.getboolean("admin", "emby_keep_alive", fallback=True)
+emby_min_seconds_between_requests = config_parser.getfloat(
+    "admin", "emby_min_seconds_between_requests", fallback=0
+)
+emby_max_seconds_between_requests = config_parser.getfloat(
+    "admin", "emby_max_seconds_between_requests", fallback=30
+)
+skip_unchanged_metadata_writes = config_parser.getboolean(
+    "admin", "skip_unchanged_metadata_writes", fallback=True
+)
+verify_unchanged_metadata_writes = config_parser.getboolean(
+    "admin", "verify_unchanged_metadata_writes", fallback=False
+)
+emby_max_url_length = config_parser.getint(
+    "admin", "emby_max_url_length", fallback=4096
+)
+emby_parallel_page_fetches = config_parser.getint(
+    "admin", "emby_parallel_page_fetches", fallback=4
+)
+emby_collection_write_workers = config_parser.getint(
+    "admin", "emby_collection_write_workers", fallback=1
+)
+mdblist_cache_ttl_minutes = config_parser.getint(
+    "admin", "mdblist_cache_ttl_minutes", fallback=60
+)
+provider_index_full_scan_hours = config_parser.getint(
+    "admin", "provider_index_full_scan_hours", fallback=24
+)
+
+plan_mdblist_api_requests = config_parser.getboolean(
+    "admin", "plan_mdblist_api_requests", fallback=True
+)
+mdblist_parallel_downloads = config_parser.getint(
+    "admin", "mdblist_parallel_downloads", fallback=4
+)
+emby_parallel_list_updates = config_parser.getint(
+    "admin", "emby_parallel_list_updates", fallback=2
+)
+
 newly_added = 0
 newly_removed = 0
 collection_ids_with_custom_sorting = []
 all_collections_ids = []
-
-emby = Emby(emby_server_url, emby_user_id, emby_api_key)
-mdblist = Mdblist(mdblist_api_key)
+# Lists are processed at the same time, see process_lists. Guards the counters and lists above.
+state_lock = threading.Lock()
+# Guards temp/db.cfg and the poster cache, which are written by several lists
+db_lock = threading.Lock()
+# Two lists for the same collection are never updated at the same time
+collection_locks = {}
+
+emby = Emby(
+    emby_server_url,
+    emby_user_id,
+    emby_api_key,
+    pool_size=emby_connection_pool_size,
+    timeout=emby_request_timeout,
+    max_retries=emby_max_retries,
+    keep_alive=emby_keep_alive,
+    rate_limiter=RateLimiter(
+        min_delay=emby_min_seconds_between_requests,
+        max_delay=emby_max_seconds_between_requests,
+    ),
+    page_fetch_workers=emby_parallel_page_fetches,
+    max_url_length=emby_max_url_length,
+    property_ledger=PropertyLedger() if skip_unchanged_metadata_writes else None,
+    verify_property_ledger=verify_unchanged_metadata_writes,
+    collection_write_workers=emby_collection_write_workers,
+)
+mdblist = Mdblist(mdblist_api_key, mdblist_cache_ttl_minutes)
 item_sorting = ItemSorting(emby)
-refresher = Refresher(emby)
+refresher = Refresher(
+    emby,
+    refresh_items_workers,
+    refresh_items_hours_between_refreshes,
+    refresh_items_max_per_cycle,
+    refresh_profile=refresh_items_profile,
+)
+provider_index = ProviderIndex(emby, provider_index_full_scan_hours)
 db_manager = Db()
+poster_cache = PosterCache()
+quota_planner = QuotaPlanner(mdblist, hours_between_refresh)
 
 
-def process_list(mdblist_list: dict):
-    global newly_added
-    global newly_removed
+def is_list_active(mdblist_list: dict) -> bool:
+    # False if the collection of the list is outside its active period
+    active_period_str = config_parser.get(
+        mdblist_list["name"], "active_between", fallback=None
+    )
+    return not active_period_str or inside_period(active_period_str)
+
+
+def fetch_list(mdblist_list: dict):
+    """
+    First stage of processing a list. Decides if the list is processed this cycle
+    and downloads its items from MDBList.
+
+    Args:
+        mdblist_list (dict): The list, see get_hardcoded_lists.
+
+    Returns:
+        dict: {"inactive": True} if the collection is outside its active period,
+            {"imdb_ids": [...], "mediatypes": [...]} with the items of the list,
+            or None if the list is skipped.
+    """
     collection_name = mdblist_list["name"]
     frequency = int(mdblist_list.get("frequency", 100))
     list_id = mdblist_list.get("id", None)
     source = mdblist_list.get("source", None)
-    poster = mdblist_list.get("poster", None)
     mdblist_name = mdblist_list.get("mdblist_name", None)
     user_name = mdblist_list.get("user_name", None)
-    update_collection_items_sort_names = mdblist_list.get(
-        "update_items_sort_names", update_items_sort_names_default_value
-    )
-    collection_sort_name = mdblist_list.get("collection_sort_name", None)
-    description = mdblist_list.get("description", None)  # Description from mdblist
-    overwrite_description = mdblist_list.get("overwrite_description", None)  # From cfg
 
     collection_id = emby.get_collection_id(collection_name)
-    active_period_str = config_parser.get(
-        collection_name, "active_between", fallback=None
-    )
 
-    if active_period_str:
-        if not inside_period(active_period_str):
-            all_items_in_collection = emby.get_items_in_collection(
-                collection_id, ["Id"]
-            )
-            item_ids = (
-                [item["Id"] for item in all_items_in_collection]
-                if all_items_in_collection is not None
-                else []
-            )
-            newly_removed += emby.delete_from_collection(collection_name, item_ids)
-            if newly_removed > 0:
-                print(f"Collection {collection_name} is not active. Removed all items.")
-                print("=========================================")
-            return
+    if not is_list_active(mdblist_list):
+        return {"inactive": True}
 
     if collection_id is None:
         print(f"Collection {collection_name} does not exist. Will create it.")
         frequency = 100  # If collection doesn't exist, download every time
 
-    print()
-    print("=========================================")
-
     if random.randint(0, 100) > frequency:
         print(f"Skipping mdblist {collection_name} since frequency is {frequency}")
-        print("=========================================")
-        return
+        return None
 
     mdblist_imdb_ids = []
     mdblist_mediatypes = []
+    mdblist.start_request_tally()
     if list_id is not None:
-        mdblist_imdb_ids, mdblist_mediatypes = mdblist.get_list(list_id)
+        # Lists from MDBList include their size, which lets all pages be requested at once
+        mdblist_imdb_ids, mdblist_mediatypes = mdblist.get_list(
+            list_id, total_items=mdblist_list.get("items")
+        )
     elif mdblist_name is not None and user_name is not None:
         found_list_id = mdblist.find_list_id_by_name_and_user(mdblist_name, user_name)
         if found_list_id is None:
             print(f"ERROR! List {mdblist_name} by {user_name} not found. Skipping.")
-            print("=========================================")
-            return
+            mdblist.end_request_tally()
+            return None
         mdblist_imdb_ids, mdblist_mediatypes = mdblist.get_list(found_list_id)
     elif source is not None:
         source = source.replace(" ", "")
@@ -129,29 +231,88 @@ def process_list(mdblist_list: dict):
         sources = [sources[0]] + [f"http{url}" for url in sources[1:]]
         for url in sources:
             imdb_ids, mediatypes = mdblist.get_list_using_url(url.strip())
+            if imdb_ids is None:
+                mdblist_imdb_ids = None
+                break
             mdblist_imdb_ids.extend(imdb_ids)
             mdblist_mediatypes.extend(mediatypes)
     else:
         print(f"ERROR! Must provide either id or source for {collection_name}.")
-        print("=========================================")
-        return
+        mdblist.end_request_tally()
+        return None
+
+    requests_used = mdblist.end_request_tally()
 
     if mdblist_imdb_ids is None:
         print(f"ERROR! No items in {collection_name}. Will not process this list.")
-        print("=========================================")
-        return
+        return None
 
-    remove_emby_ids = []
-    missing_imdb_ids = []
+    # Failed downloads are not recorded, so the list stays first in line
+    quota_planner.record_fetched(mdblist_list, requests_used)
 
     if len(mdblist_imdb_ids) == 0:
         print(
             f"ERROR! No items in mdblist {collection_name}. Will not process this list. Perhaps you need to wait for it to populate?"
         )
+        return None
+
+    return {"imdb_ids": mdblist_imdb_ids, "mediatypes": mdblist_mediatypes}
+
+
+def sync_list(mdblist_list: dict, fetched: dict):
+    """
+    Second stage of processing a list. Updates the collection in Emby with the
+    items downloaded by fetch_list.
+
+    Args:
+        mdblist_list (dict): The list, see get_hardcoded_lists.
+        fetched (dict): What fetch_list returned for the list.
+    """
+    collection_name = mdblist_list["name"]
+    with state_lock:
+        collection_lock = collection_locks.setdefault(collection_name, threading.Lock())
+    with collection_lock:
+        if fetched.get("inactive"):
+            remove_all_from_inactive_collection(collection_name)
+        else:
+            update_collection(mdblist_list, fetched)
+
+
+def remove_all_from_inactive_collection(collection_name: str):
+    global newly_removed
+    collection_id = emby.get_collection_id(collection_name)
+    all_items_in_collection = emby.get_items_in_collection(collection_id, ["Id"])
+    item_ids = (
+        [item["Id"] for item in all_items_in_collection]
+        if all_items_in_collection is not None
+        else []
+    )
+    removed_count = emby.delete_from_collection(collection_name, item_ids)
+    with state_lock:
+        newly_removed += removed_count
+    if removed_count > 0:
+        print(f"Collection {collection_name} is not active. Removed all items.")
         print("=========================================")
-        return
 
-    mdblist_imdb_ids = list(set(mdblist_imdb_ids))  # Remove duplicates
+
+def update_collection(mdblist_list: dict, fetched: dict):
+    global newly_added
+    global newly_removed
+    collection_name = mdblist_list["name"]
+    poster = mdblist_list.get("poster", None)
+    collection_sort_name = mdblist_list.get("collection_sort_name", None)
+    description = mdblist_list.get("description", None)  # Description from mdblist
+    overwrite_description = mdblist_list.get("overwrite_description", None)  # From cfg
+    mdblist_imdb_ids = fetched["imdb_ids"]
+    mdblist_mediatypes = fetched["mediatypes"]
+
+    print()
+    print("=========================================")
+
+    remove_emby_ids = []
+    missing_imdb_ids = []
+
+    mdblist_imdb_ids = list(dict.fromkeys(mdblist_imdb_ids))  # Remove duplicates
     print(f"Processing {collection_name}. List has {len(mdblist_imdb_ids)} IMDB IDs")
     collection_id = emby.get_collection_id(collection_name)
 
@@ -167,17 +328,27 @@ def process_list(mdblist_list: dict):
             print("=========================================")
             return
 
-        collection_imdb_ids = [item["Imdb"] for item in collection_items]
-        missing_imdb_ids = find_missing_entries_in_list(
-            collection_imdb_ids, mdblist_imdb_ids
-        )
+        if collection_items is None:
+            print(f"Error getting items in collection {collection_name}")
+            print("=========================================")
+            return
 
-        for item in collection_items:
-            if item["Imdb"] not in mdblist_imdb_ids:
-                remove_emby_ids.append(item["Id"])
+        diff = diff_collection(collection_items, mdblist_imdb_ids)
+        missing_imdb_ids = diff["add"]
+        remove_emby_ids = diff["remove"]
 
     # Need Emby Item Ids instead of IMDB IDs to add to collection
-    add_emby_ids = emby.get_items_with_imdb_id(missing_imdb_ids, mdblist_mediatypes)
+    if provider_index.is_built():
+        add_emby_ids = provider_index.resolve(
+            "imdb", missing_imdb_ids, mdblist_mediatypes
+        )
+    else:
+        add_emby_ids = emby.get_items_with_imdb_id(missing_imdb_ids, mdblist_mediatypes)
+
+    if add_emby_ids is None:
+        print(f"Error looking up the items of {collection_name} in Emby")
+        print("=========================================")
+        return
 
     print()
     print(f"Added {len(add_emby_ids)} new items and removed {len(remove_emby_ids)}")
@@ -191,15 +362,13 @@ def process_list(mdblist_list: dict):
         collection_id = emby.create_collection(collection_name, [add_emby_ids[0]])
         add_emby_ids.pop(0)
 
-    if collection_id not in all_collections_ids:
-        all_collections_ids.append(collection_id)
-
-    if update_collection_items_sort_names is True:
-        collection_ids_with_custom_sorting.append(collection_id)
+    register_collection(mdblist_list, collection_id)
 
     items_added = emby.add_to_collection(collection_name, add_emby_ids)
-    newly_added += items_added
-    newly_removed += emby.delete_from_collection(collection_name, remove_emby_ids)
+    items_removed = emby.delete_from_collection(collection_name, remove_emby_ids)
+    with state_lock:
+        newly_added += items_added
+        newly_removed += items_removed
 
     set_poster(collection_id, collection_name, poster)
 
@@ -229,17 +398,99 @@ def process_list(mdblist_list: dict):
     print("=========================================")
 
 
-def process_my_lists_on_mdblist():
+def register_collection(mdblist_list: dict, collection_id):
+    """
+    Adds the collection of a list to the collections whose items are sorted and refreshed
+    after the lists are processed.
+    """
+    update_collection_items_sort_names = mdblist_list.get(
+        "update_items_sort_names", update_items_sort_names_default_value
+    )
+    with state_lock:
+        if collection_id not in all_collections_ids:
+            all_collections_ids.append(collection_id)
+
+        if (
+            update_collection_items_sort_names is True
+            and collection_id not in collection_ids_with_custom_sorting
+        ):
+            collection_ids_with_custom_sorting.append(collection_id)
+
+
+def process_lists(mdblist_lists: list):
+    """
+    Processes lists in two stages that run at the same time. Up to mdblist_parallel_downloads
+    lists are downloaded from MDBList at once with fetch_list, and every downloaded list is
+    handed to up to emby_parallel_list_updates workers that update its collection in Emby
+    with sync_list. A cycle takes about as long as the slower of the two stages instead
+    of the sum of both. What is printed for a list is held back and printed in one block
+    when the list is done, see ListOutput.
+
+    Args:
+        mdblist_lists (list): The lists to process, see get_hardcoded_lists.
+    """
+    if plan_mdblist_api_requests:
+        quota_planner.start_cycle()
+        scheduled_lists = quota_planner.plan(mdblist_lists, is_list_active)
+        scheduled_ids = {id(mdblist_list) for mdblist_list in scheduled_lists}
+        # Deferred lists keep their collections as they are, but the sort names of their
+        # items must not be reset as if the collections were gone
+        for mdblist_list in mdblist_lists:
+            if id(mdblist_list) not in scheduled_ids:
+                collection_id = emby.get_collection_id(mdblist_list["name"])
+                if collection_id is not None:
+                    register_collection(mdblist_list, collection_id)
+        mdblist_lists = scheduled_lists
+
+    # The messages of each list are printed together once the list is done
+    output = ListOutput(sys.stdout)
+
+    def sync_and_print(mdblist_list, fetched, fetch_messages):
+        _, sync_messages = output.capture(sync_list, mdblist_list, fetched)
+        output.write_block(fetch_messages + sync_messages)
+
+    sys.stdout = output
+    try:
+        with ThreadPoolExecutor(
+            max_workers=mdblist_parallel_downloads
+        ) as fetch_executor, ThreadPoolExecutor(
+            max_workers=emby_parallel_list_updates
+        ) as sync_executor:
+            fetches = {
+                fetch_executor.submit(
+                    output.capture, fetch_list, mdblist_list
+                ): mdblist_list
+                for mdblist_list in mdblist_lists
+            }
+            syncs = []
+            for fetch in as_completed(fetches):
+                fetched, fetch_messages = fetch.result()
+                if fetched is None:
+                    output.write_block(fetch_messages)
+                    continue
+                syncs.append(
+                    sync_executor.submit(
+                        sync_and_print, fetches[fetch], fetched, fetch_messages
+                    )
+                )
+            for sync in syncs:
+                sync.result()
+    finally:
+        sys.stdout = output.stream
+
+    if plan_mdblist_api_requests:
+        quota_planner.end_cycle()
+
+
+def get_my_lists_on_mdblist() -> list:
     my_lists = mdblist.get_my_lists()
     if len(my_lists) == 0:
         print("ERROR! No lists returned from MDBList API. Will not process any lists.")
-        return
-
-    for mdblist_list in my_lists:
-        process_list(mdblist_list)
+        return []
+    return my_lists
 
 
-def process_hardcoded_lists():
+def get_hardcoded_lists() -> list:
     collections = []
     for section in config_parser.sections():
         if section == "admin":
@@ -270,14 +521,13 @@ def process_hardcoded_lists():
         except configparser.NoOptionError as e:
             print(f"Error in config file, section: {section}: {e}")
 
-    for mdblist_list in collections:
-        process_list(mdblist_list)
+    return collections
 
 
 def set_poster(collection_id, collection_name, poster_path=None):
     """
-    Sets the poster for a collection. Will not upload if temp config file
-    shows that it been uploaded before.
+    Sets the poster for a collection. Will not upload if the poster cache shows
+    that an image with the same content has been uploaded before.
 
     Args:
         collection_id (str): The ID of the collection.
@@ -291,12 +541,31 @@ def set_poster(collection_id, collection_name, poster_path=None):
     if poster_path is None:
         return
 
-    if poster_path == db_manager.get_config_for_section(collection_id, "poster_path"):
-        print(f"Poster for {collection_name} is already set to the specified path.")
+    fingerprint = poster_cache.fingerprint(collection_id, poster_path)
+    if fingerprint is None:
+        print(f"Failed to set poster for {collection_name}.")
+        return
+
+    with db_lock:
+        uploaded_before = poster_cache.is_uploaded(collection_id, fingerprint)
+        if poster_cache.get(collection_id) is None and poster_path == (
+            db_manager.get_config_for_section(collection_id, "poster_path")
+        ):
+            # Uploaded by an earlier version that only stored the path
+            uploaded_before = True
+
+        if uploaded_before:
+            # The path or the validators of a remote poster may have changed
+            poster_cache.record(collection_id, fingerprint)
+
+    if uploaded_before:
+        print(f"Poster for {collection_name} is already set to the specified image.")
         return
 
     if emby.set_image(collection_id, poster_path):
-        db_manager.set_config_for_section(collection_id, "poster_path", poster_path)
+        with db_lock:
+            db_manager.set_config_for_section(collection_id, "poster_path", poster_path)
+            poster_cache.record(collection_id, fingerprint)
         print(f"Poster for {collection_name} has been set successfully.")
     else:
         print(f"Failed to set poster for {collection_name}.")
@@ -346,11 +615,21 @@ def main():
             time.sleep(300)
             continue
 
+        emby.invalidate_collection_index()
+        emby.reset_max_url_length()
+        provider_index.build()
+
+        # Property updates for collections and items are merged and written after sorting
+        emby.start_update_batch()
+
+        mdblist_lists = []
         if download_manually_added_lists:
-            process_hardcoded_lists()
+            mdblist_lists += get_hardcoded_lists()
 
         if download_my_mdblist_lists_automatically:
-            process_my_lists_on_mdblist()
+            mdblist_lists += get_my_lists_on_mdblist()
+
+        process_lists(mdblist_lists)
 
         print(
             f"\nSUMMARY: Added {newly_added} to collections and removed {newly_removed}\n"
@@ -363,11 +642,10 @@ def main():
             for collection_id in collection_ids_with_custom_sorting:
                 item_sorting.process_collection(collection_id)
 
-            print(
-                "\n\nReverting sort names that are no longer in collections, fetching items:"
-            )
+            print("\n\nReverting sort names that are no longer in collections")
 
         item_sorting.reset_items_not_in_custom_sort_categories()
+        emby.flush_updates()
 
         if refresh_items is True:
             print(
@@ -380,8 +658,25 @@ def main():
                     collection_id,
                     refresh_items_max_days_since_added,
                     refresh_items_max_days_since_premiered,
+                    refresh_items_show_rating_change,
                 )
 
+        if refresh_items is True:
+            refresher.refresh_queued_items()
+            refresher.report_rating_changes()
+
+        connection_stats = emby.get_connection_stats(reset=True)
+        print(
+            f"\nEmby requests this cycle: {connection_stats['requests']}, "
+            f"reused connections: {connection_stats['reused_connections']}, "
+            f"new connections: {connection_stats['new_connections']}"
+        )
+        throttle_stats = emby.rate_limiter.get_stats(reset=True)
+        print(
+            f"Emby throttling this cycle: {throttle_stats['throttled_seconds']:.1f} seconds, "
+            f"backed off {throttle_stats['backoffs']} times"
+        )
+
         if hours_between_refresh == 0:
             break
 
@@ -11,7 +11,6 @@ import datetime
 
 directory = "backup"
 backup_filters = ["IsPlayed", "IsFavorite"]
-seconds_between_requests = 10
 
 config_parser = configparser.ConfigParser()
 
@@ -32,7 +31,6 @@ emby_server_url = config_parser.get("admin", "emby_server_url")
 emby_user_id = config_parser.get("admin", "emby_user_id")
 emby_api_key = config_parser.get("admin", "emby_api_key")
 emby = Emby(emby_server_url, emby_user_id, emby_api_key)
-emby.seconds_between_requests = seconds_between_requests
 
 
 def get_all_items(user_id, filter):
@@ -43,36 +41,41 @@ def get_all_items(user_id, filter):
         fields.append("UserDataLastPlayedDate")
         include_item_types = ["Movie", "Episode"]
 
-    items = emby.get_items(
+    returned_items = []
+    # Items are compacted page by page so the full item data is never all in memory
+    for items in emby.iter_item_pages(
         params={"userId": user_id},
         fields=fields,
         include_item_types=include_item_types,
         filters=[filter],
-    )
+    ):
+        if items is None:
+            return None
+        returned_items.extend(compact_item(item) for item in items)
 
-    returned_items = []
-    for item in items:
-        include_fields = [
-            "Id",
-            "Name",
-            "ProviderIds",
-            "Type",
-        ]
-        item_data = {key: item[key] for key in include_fields if key in item}
-        include_provider_ids = ["imdb", "tmdb", "tvdb"]
-        if "ProviderIds" in item_data:
-            item_data["ProviderIds"] = {
-                key: value
-                for key, value in item_data["ProviderIds"].items()
-                if key.lower() in include_provider_ids
-            }
+    return returned_items
 
-        if "UserData" in item and "LastPlayedDate" in item["UserData"]:
-            item_data["LastPlayedDate"] = item["UserData"]["LastPlayedDate"]
 
-        returned_items.append(item_data)
+def compact_item(item):
+    include_fields = [
+        "Id",
+        "Name",
+        "ProviderIds",
+        "Type",
+    ]
+    item_data = {key: item[key] for key in include_fields if key in item}
+    include_provider_ids = ["imdb", "tmdb", "tvdb"]
+    if "ProviderIds" in item_data:
+        item_data["ProviderIds"] = {
+            key: value
+            for key, value in item_data["ProviderIds"].items()
+            if key.lower() in include_provider_ids
+        }
 
-    return returned_items
+    if "UserData" in item and "LastPlayedDate" in item["UserData"]:
+        item_data["LastPlayedDate"] = item["UserData"]["LastPlayedDate"]
+
+    return item_data
 
 
 def main():
@@ -101,6 +104,9 @@ def main():
             }
             print(f"\nGetting {filter} items for {user_name}")
             data["Items"] = get_all_items(user_id, filter)
+            if data["Items"] is None:
+                print(f"\nError getting {filter} items for {user_name}, skipping.")
+                continue
             file_name = f"{directory}/{now_str}_{filter}_{user_name}.json"
             print(f"\nWriting {len(data['Items'])} items to {file_name}")
             with open(file_name, "w", encoding="utf-8") as f:
@@ -35,7 +35,9 @@ Json file exmple:
 """
 
 from src.emby import Emby
+from src.async_emby import AsyncEmby
 import ast
+import asyncio
 import sys
 from argparse import ArgumentParser
 
@@ -53,8 +55,7 @@ def add_error(error):
 
 
 def main(args):
-    emby = Emby(args.host, args.user_id, args.api_key)
-    emby.seconds_between_requests = 0.1
+    emby = Emby(args.host, args.user_id, args.api_key, pool_size=args.max_concurrency)
 
     emby_info = emby.get_system_info()
     if emby_info is False:
@@ -72,77 +73,85 @@ def main(args):
     items = ast.literal_eval(backup_data)["Items"]
     user_id = args.user_id
 
-    for item in items:
+    emby = AsyncEmby(emby, args.max_concurrency)
+    asyncio.run(restore_items(emby, items, filter, user_id))
 
-        if "Id" not in item or "Name" not in item:
-            add_error(f"{item} is missing Id or Name")
-            continue
 
-        item_id = int(item["Id"])
-        new_item_ids = None
-        item_name = item["Name"]
-        item_type = item["Type"]
+async def restore_items(emby, items, filter, user_id):
+    # Items are independent of each other so lookups and writes for several items can overlap
+    await asyncio.gather(*[restore_item(emby, item, filter, user_id) for item in items])
 
-        imdb_id = None
-        tvdb_id = None
 
-        provider_ids = item.get("ProviderIds", None)
+async def restore_item(emby, item, filter, user_id):
+    if "Id" not in item or "Name" not in item:
+        add_error(f"{item} is missing Id or Name")
+        return
 
-        if provider_ids is None:
-            add_error(f"{item_id}:{item_name} is missing ProviderIds")
-            continue
+    item_id = int(item["Id"])
+    new_item_ids = None
+    item_name = item["Name"]
+    item_type = item["Type"]
 
-        imdb_id = get_provider_id(provider_ids, "imdb")
-        tvdb_id = get_provider_id(provider_ids, "tvdb")
+    imdb_id = None
+    tvdb_id = None
 
-        if imdb_id is None and tvdb_id is None:
-            add_error(f"Can not find IMDB or TVDB ID for: {item_id}: {item_name}")
-            continue
+    provider_ids = item.get("ProviderIds", None)
 
-        if item_type not in ["Series", "Episode", "Movie"]:
-            add_error(f"{item_id}:{item_name} has invalid type {item_type}")
-            continue
+    if provider_ids is None:
+        add_error(f"{item_id}:{item_name} is missing ProviderIds")
+        return
 
-        if item_type == "Episode":
+    imdb_id = get_provider_id(provider_ids, "imdb")
+    tvdb_id = get_provider_id(provider_ids, "tvdb")
 
-            if tvdb_id is None:
-                add_error(f"Can not find TVDB ID for episode {item_id}: {item_name}")
-                continue
+    if imdb_id is None and tvdb_id is None:
+        add_error(f"Can not find IMDB or TVDB ID for: {item_id}: {item_name}")
+        return
 
-            new_item_ids = emby.get_items_with_tvdb_id([tvdb_id], [item_type])
+    if item_type not in ["Series", "Episode", "Movie"]:
+        add_error(f"{item_id}:{item_name} has invalid type {item_type}")
+        return
 
-        elif item_type == "Series" or item_type == "Movie":
+    if item_type == "Episode":
 
-            if imdb_id is not None:  # Prefer IMDB first I guess
-                new_item_ids = emby.get_items_with_imdb_id([imdb_id], [item_type])
-            elif tvdb_id is not None:
-                new_item_ids = emby.get_items_with_tvdb_id([tvdb_id], [item_type])
+        if tvdb_id is None:
+            add_error(f"Can not find TVDB ID for episode {item_id}: {item_name}")
+            return
 
-        if new_item_ids is None or new_item_ids == []:
-            add_error(
-                f"Can not find new Item for TVDB: {tvdb_id} IMDB: {imdb_id} Name: {item_name}. "
-            )
-            continue
+        new_item_ids = await emby.get_items_with_tvdb_id([tvdb_id], [item_type])
+
+    elif item_type == "Series" or item_type == "Movie":
+
+        if imdb_id is not None:  # Prefer IMDB first I guess
+            new_item_ids = await emby.get_items_with_imdb_id([imdb_id], [item_type])
+        elif tvdb_id is not None:
+            new_item_ids = await emby.get_items_with_tvdb_id([tvdb_id], [item_type])
+
+    if new_item_ids is None or new_item_ids == []:
+        add_error(
+            f"Can not find new Item for TVDB: {tvdb_id} IMDB: {imdb_id} Name: {item_name}. "
+        )
+        return
 
-        # Ensure new_item_ids is a list before iterating
-        if not isinstance(new_item_ids, list):
-            add_error(
-                f"Unexpected result type for new_item_ids: {type(new_item_ids)} for {item_name}"
+    # Ensure new_item_ids is a list before iterating
+    if not isinstance(new_item_ids, list):
+        add_error(
+            f"Unexpected result type for new_item_ids: {type(new_item_ids)} for {item_name}"
+        )
+        return
+
+    for new_item_id in new_item_ids:
+        if filter == "IsPlayed":
+            last_played_date = item.get("LastPlayedDate")
+            set_as_played = await emby.set_item_as_played(
+                user_id, new_item_id, date_played=last_played_date
             )
-            continue
-
-        for new_item_id in new_item_ids:
-            if filter == "IsPlayed":
-                last_played_date = item.get("LastPlayedDate")
-                set_as_played = emby.set_item_as_played(
-                    user_id, new_item_id, date_played=last_played_date
-                )
-                if not set_as_played:
-                    add_error(f"Cannot set to IsPlayed {new_item_id}: {item_name}")
-            elif filter == "IsFavorite":
-                set_as_favorite = emby.set_item_as_favorite(user_id, new_item_id)
-                if not set_as_favorite:
-                    add_error(f"Cannot set to IsFavorite {item_id}: {item_name}")
+            if not set_as_played:
+                add_error(f"Cannot set to IsPlayed {new_item_id}: {item_name}")
+        elif filter == "IsFavorite":
+            set_as_favorite = await emby.set_item_as_favorite(user_id, new_item_id)
+            if not set_as_favorite:
+                add_error(f"Cannot set to IsFavorite {item_id}: {item_name}")
 
 
 if __name__ == "__main__":
@@ -165,5 +174,12 @@ if __name__ == "__main__":
         dest="source_file",
         help="Source file to restore from",
     )
+    parser.add_argument(
+        "-max_concurrency",
+        dest="max_concurrency",
+        type=int,
+        default=4,
+        help="Maximum number of requests to Emby running at the same time",
+    )
     args = parser.parse_args()
     main(args)
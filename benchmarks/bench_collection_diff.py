@@ -0,0 +1,67 @@
+"""
+Micro-benchmark for diff_collection against the list based comparison it replaced.
+
+Builds a synthetic collection and target list of 10k and 100k IMDb IDs with 10%
+of the items changed and times both approaches. The list based comparison is
+quadratic and only run up to 10k IDs.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_collection_diff
+"""
+
+import random
+import time
+
+from src.collection_diff import diff_collection
+
+list_based_max_size = 10000
+
+
+def list_based_diff(collection_items, target_imdb_ids):
+    # The comparison process_list used before diff_collection
+    collection_imdb_ids = [item["Imdb"] for item in collection_items]
+    add = [imdb_id for imdb_id in target_imdb_ids if imdb_id not in collection_imdb_ids]
+    remove = [
+        item["Id"] for item in collection_items if item["Imdb"] not in target_imdb_ids
+    ]
+    return add, remove
+
+
+def synthetic_data(size):
+    changed = size // 10
+    collection_items = [
+        {"Id": str(100000 + index), "Imdb": f"tt{index:08d}"} for index in range(size)
+    ]
+    target_imdb_ids = [f"tt{index:08d}" for index in range(changed, size + changed)]
+    random.shuffle(target_imdb_ids)
+    return collection_items, target_imdb_ids
+
+
+def timed(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start_time
+
+
+def main():
+    for size in [10000, 100000]:
+        collection_items, target_imdb_ids = synthetic_data(size)
+        diff, diff_seconds = timed(diff_collection, collection_items, target_imdb_ids)
+        print(
+            f"{size} IDs: diff_collection {diff_seconds * 1000:.1f} ms "
+            f"(add {len(diff['add'])}, remove {len(diff['remove'])}, unchanged {len(diff['unchanged'])})"
+        )
+
+        if size > list_based_max_size:
+            print(f"{size} IDs: list based comparison skipped, quadratic")
+            continue
+        (add, remove), list_seconds = timed(
+            list_based_diff, collection_items, target_imdb_ids
+        )
+        assert add == diff["add"] and remove == diff["remove"]
+        print(f"{size} IDs: list based comparison {list_seconds * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark for Emby.get_items_in_collection against a synthetic 10k-item collection.
+
+Starts a local fake Emby server that returns full item records (overview, image tags,
+user data etc.) unless the request asks for lean items, then compares a single unpaged
+request with default fields, as the collection used to be fetched, with the paged and
+lean get_items_in_collection.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_collection_items
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from src.emby import Emby
+
+collection_size = 10000
+collection_id = "1"
+
+
+def full_item(index):
+    return {
+        "Id": str(100000 + index),
+        "Name": f"Movie {index}",
+        "Type": "Movie",
+        "ServerId": "abc123",
+        "Overview": "A synthetic overview of the movie. " * 15,
+        "ProviderIds": {"Imdb": f"tt{index:07d}", "Tmdb": str(index)},
+        "PremiereDate": "2024-01-01T00:00:00.0000000Z",
+        "DateCreated": "2024-01-01T00:00:00.0000000Z",
+        "CommunityRating": 7.1,
+        "ImageTags": {"Primary": "a" * 32, "Logo": "b" * 32, "Thumb": "c" * 32},
+        "BackdropImageTags": ["d" * 32, "e" * 32],
+        "UserData": {"PlaybackPositionTicks": 0, "PlayCount": 0, "Played": False},
+        "Genres": ["Drama", "Thriller"],
+        "Studios": [{"Name": "Studio", "Id": 1}],
+    }
+
+
+items = [full_item(index) for index in range(collection_size)]
+lean_keys = ["Id", "Name", "Type"]
+
+
+class FakeEmby(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        query = {
+            key: value[0] for key, value in parse_qs(urlparse(self.path).query).items()
+        }
+        if self.path.endswith("/System/Info"):
+            body = {"ServerName": "benchmark"}
+        else:
+            start = int(query.get("StartIndex", 0))
+            limit = int(query.get("Limit", collection_size))
+            page = items[start : start + limit]
+            if query.get("EnableImages") == "false":
+                keep = lean_keys + query.get("Fields", "").split(",")
+                page = [
+                    {key: item[key] for key in keep if key in item} for item in page
+                ]
+            body = {"Items": page, "TotalRecordCount": collection_size}
+
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeEmby)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server_url = f"http://127.0.0.1:{server.server_address[1]}"
+    emby = Emby(server_url, "user", "key")
+
+    start_time = time.perf_counter()
+    response = requests.get(
+        f"{server_url}/emby/users/user/items?Parentid={collection_id}&Fields=ProviderIds"
+    )
+    unpaged_items = response.json()["Items"]
+    unpaged_seconds = time.perf_counter() - start_time
+    unpaged_bytes = len(response.content)
+
+    start_time = time.perf_counter()
+    lean_items = emby.get_items_in_collection(collection_id, ["ProviderIds"])
+    lean_seconds = time.perf_counter() - start_time
+    print()
+
+    page_count = -(-collection_size // emby.collection_page_size)
+    lean_bytes = sum(
+        len(
+            requests.get(
+                f"{server_url}/emby/users/user/items",
+                params={
+                    "ParentId": collection_id,
+                    "EnableImages": "false",
+                    "Fields": "ProviderIds",
+                    "StartIndex": page * emby.collection_page_size,
+                    "Limit": emby.collection_page_size,
+                },
+            ).content
+        )
+        for page in range(page_count)
+    )
+
+    print(f"Collection of {collection_size} items")
+    print(
+        f"Unpaged, default fields: {len(unpaged_items)} items, {unpaged_bytes / 1e6:.1f} MB, {unpaged_seconds:.2f} s"
+    )
+    print(
+        f"Paged, lean:             {len(lean_items)} items, {lean_bytes / 1e6:.1f} MB in {page_count} pages, {lean_seconds:.2f} s"
+    )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
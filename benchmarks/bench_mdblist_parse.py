@@ -0,0 +1,140 @@
+"""
+Memory benchmark for parsing MDBList list responses while they are read, against
+loading the whole response with response.json() as get_list did before.
+
+Writes a synthetic 50k item list in the format of the list items API to a temporary
+file, then measures the peak memory of extracting the IMDb IDs and media types with
+tracemalloc. Both approaches read the body from the file, like a response cached in
+temp/mdblist_cache, so the body itself is included in the old approach's peak.
+
+Before measuring, a small document with numbers, strings and nested values is parsed
+with every chunk size from 1 byte up, so values split at any chunk boundary are checked.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_mdblist_parse
+"""
+
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from src.json_stream import iter_array_items
+
+list_size = 50000
+chunk_size = 64 * 1024
+id_fields = ["imdb_id", "mediatype"]
+
+
+def synthetic_list(size):
+    items = [
+        {
+            "id": 100000 + index,
+            "rank": index + 1,
+            "adult": 0,
+            "title": f"Synthetic title number {index}",
+            "imdb_id": f"tt{index:08d}",
+            "tvdb_id": 200000 + index if index % 3 else None,
+            "mediatype": "movie" if index % 4 else "show",
+            "release_year": 1950 + index % 75,
+            "language": "en",
+            "spoken_language": "en",
+        }
+        for index in range(size)
+    ]
+    return {
+        "movies": [item for item in items if item["mediatype"] == "movie"],
+        "shows": [item for item in items if item["mediatype"] == "show"],
+    }
+
+
+def whole_response(path):
+    # The parsing get_list did before: response.json(), then all_items, then the IDs
+    with open(path, "rb") as f:
+        body = f.read()
+    result = json.loads(body)
+    all_items = result.get("movies", []) + result.get("shows", [])
+    imdb_ids = [item["imdb_id"] for item in all_items if "imdb_id" in item]
+    mediatypes = list(dict.fromkeys(item["mediatype"] for item in all_items))
+    return imdb_ids, mediatypes
+
+
+def streamed_response(path):
+    items = {}
+    with open(path, "rb") as f:
+        chunks = iter(lambda: f.read(chunk_size), b"")
+        for key, item in iter_array_items(chunks, ["movies", "shows"]):
+            item = {field: item[field] for field in id_fields if field in item}
+            items.setdefault(key, []).append(item)
+    all_items = items.get("movies", []) + items.get("shows", [])
+    imdb_ids = [item["imdb_id"] for item in all_items if "imdb_id" in item]
+    mediatypes = list(dict.fromkeys(item["mediatype"] for item in all_items))
+    return imdb_ids, mediatypes
+
+
+def check_chunk_boundaries():
+    document = json.dumps(
+        {
+            "count": 7.5,
+            "offset": -12,
+            "score": 1.5e-3,
+            "flags": [True, False, None],
+            "movies": [
+                {"imdb_id": "tt0133093", "rank": 1, "rating": 8.7},
+                {"imdb_id": "tt\u00e9", "rank": -2, "rating": 6e2, "tags": ["a", 3]},
+            ],
+            "shows": [1, 22.25, -0.5, 1e10, "x"],
+        },
+        ensure_ascii=False,
+    ).encode("utf-8")
+    expected = json.loads(document)
+    expected_items = [
+        (key, item) for key in ["movies", "shows"] for item in expected[key]
+    ]
+    for size in range(1, len(document) + 1):
+        chunks = [document[i : i + size] for i in range(0, len(document), size)]
+        items = list(iter_array_items(chunks, ["movies", "shows"]))
+        assert items == expected_items, f"Chunk size {size}: {items}"
+    print(f"Chunk boundaries: parsed with all {len(document)} chunk sizes")
+
+
+def measured(function, path):
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    result = function(path)
+    seconds = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak, seconds
+
+
+def main():
+    check_chunk_boundaries()
+    fd, path = tempfile.mkstemp(suffix=".json")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(synthetic_list(list_size), f)
+        print(
+            f"Synthetic list: {list_size} items, {os.path.getsize(path) / 1e6:.1f} MB"
+        )
+
+        whole_result, whole_peak, whole_seconds = measured(whole_response, path)
+        streamed_result, streamed_peak, streamed_seconds = measured(
+            streamed_response, path
+        )
+        assert whole_result == streamed_result
+
+        print(
+            f"response.json(): peak {whole_peak / 1e6:.1f} MB, {whole_seconds * 1000:.0f} ms"
+        )
+        print(
+            f"streamed:        peak {streamed_peak / 1e6:.1f} MB, {streamed_seconds * 1000:.0f} ms"
+        )
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import asyncio
+
+
+class AsyncEmby:
+    """
+    Asyncio version of the Emby client with the same methods as Emby.
+
+    Each call runs the blocking Emby method in a worker thread, with at most
+    max_concurrency calls running at the same time, so independent lookups and
+    writes can overlap instead of waiting on each round trip. All calls share the
+    connection pool and rate limiter of the wrapped Emby instance, so create it with
+    a pool_size of at least max_concurrency.
+
+    get_items and iter_item_pages request their pages one at a time here, so they send
+    one request at a time like the other calls. Calls that fetch pages or write batches
+    in parallel inside Emby, like get_items_in_collection and add_to_collection, can still
+    have up to page_fetch_workers or collection_write_workers requests in flight each.
+
+    Example:
+        emby = AsyncEmby(Emby(server_url, user_id, api_key), max_concurrency=4)
+        items = await asyncio.gather(*[emby.get_item(item_id) for item_id in item_ids])
+        async for items in emby.iter_item_pages(fields=["ProviderIds"], limit=1000):
+            ...
+
+    Attributes:
+        emby (object): The wrapped Emby instance.
+        max_concurrency (int): Maximum number of calls running at the same time.
+    """
+
+    def __init__(self, emby, max_concurrency=4):
+        self.emby = emby
+        self.max_concurrency = max_concurrency
+        self.__semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def __call(self, method, *args, **kwargs):
+        async with self.__semaphore:
+            return await asyncio.to_thread(method, *args, **kwargs)
+
+    async def get_system_info(self):
+        return await self.__call(self.emby.get_system_info)
+
+    async def get_users(self):
+        return await self.__call(self.emby.get_users)
+
+    async def get_items(self, *args, **kwargs):
+        kwargs.setdefault("parallel", 1)
+        return await self.__call(self.emby.get_items, *args, **kwargs)
+
+    async def iter_item_pages(self, *args, **kwargs):
+        # Each page is requested in a worker thread, see Emby.iter_item_pages
+        kwargs.setdefault("parallel", 1)
+        pages = self.emby.iter_item_pages(*args, **kwargs)
+        end = object()
+        try:
+            while True:
+                items = await self.__call(next, pages, end)
+                if items is end:
+                    return
+                yield items
+        finally:
+            pages.close()
+
+    async def get_items_by_ids(self, item_ids, fields=None):
+        return await self.__call(self.emby.get_items_by_ids, item_ids, fields)
+
+    async def get_item(self, item_id):
+        return await self.__call(self.emby.get_item, item_id)
+
+    async def get_items_starting_with_sort_name(self, *args, **kwargs):
+        return await self.__call(
+            self.emby.get_items_starting_with_sort_name, *args, **kwargs
+        )
+
+    async def get_items_with_imdb_id(self, imdb_ids, item_types=None):
+        return await self.__call(self.emby.get_items_with_imdb_id, imdb_ids, item_types)
+
+    async def get_items_with_tvdb_id(self, tvdb_ids, item_types=None):
+        return await self.__call(self.emby.get_items_with_tvdb_id, tvdb_ids, item_types)
+
+    async def get_all_collections(self, include_contents=True):
+        return await self.__call(self.emby.get_all_collections, include_contents)
+
+    async def get_items_in_collection(self, *args, **kwargs):
+        return await self.__call(self.emby.get_items_in_collection, *args, **kwargs)
+
+    async def get_collection_id(self, collection_name):
+        return await self.__call(self.emby.get_collection_id, collection_name)
+
+    async def get_collection_info(self, collection_id):
+        return await self.__call(self.emby.get_collection_info, collection_id)
+
+    async def invalidate_collection_index(self):
+        return await self.__call(self.emby.invalidate_collection_index)
+
+    async def create_collection(self, collection_name, item_ids):
+        return await self.__call(self.emby.create_collection, collection_name, item_ids)
+
+    async def add_to_collection(self, *args, **kwargs):
+        return await self.__call(self.emby.add_to_collection, *args, **kwargs)
+
+    async def delete_from_collection(self, *args, **kwargs):
+        return await self.__call(self.emby.delete_from_collection, *args, **kwargs)
+
+    async def delete_item(self, item_id):
+        return await self.__call(self.emby.delete_item, item_id)
+
+    async def set_item_property(self, item_id, property_name, property_value):
+        return await self.__call(
+            self.emby.set_item_property, item_id, property_name, property_value
+        )
+
+    async def start_update_batch(self):
+        return await self.__call(self.emby.start_update_batch)
+
+    async def flush_updates(self):
+        return await self.__call(self.emby.flush_updates)
+
+    async def refresh_item(self, *args, **kwargs):
+        return await self.__call(self.emby.refresh_item, *args, **kwargs)
+
+    async def set_item_as_played(self, user_id, item_id, date_played=None):
+        return await self.__call(
+            self.emby.set_item_as_played, user_id, item_id, date_played
+        )
+
+    async def set_item_as_favorite(self, user_id, item_id):
+        return await self.__call(self.emby.set_item_as_favorite, user_id, item_id)
+
+    async def set_image(self, *args, **kwargs):
+        return await self.__call(self.emby.set_image, *args, **kwargs)
+
+    async def get_connection_stats(self, reset=False):
+        return await self.__call(self.emby.get_connection_stats, reset)
+
+    async def reset_max_url_length(self):
+        return await self.__call(self.emby.reset_max_url_length)
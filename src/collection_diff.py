@@ -0,0 +1,43 @@
+def diff_collection(collection_items: list, target_imdb_ids: list) -> dict:
+    """
+    Compares the items currently in a collection with the IMDb IDs it should contain.
+    Runs in linear time by using sets for the membership tests.
+
+    Args:
+        collection_items (list): Items in the collection as returned by
+            Emby.get_items_in_collection with ProviderIds, each with "Id" and "Imdb".
+        target_imdb_ids (list): IMDb IDs the collection should contain.
+
+    Returns:
+        dict: {
+            "add": IMDb IDs not in the collection yet, in the order of target_imdb_ids
+                and without duplicates,
+            "remove": Emby IDs of items whose IMDb ID is not in target_imdb_ids,
+                in collection order. Items without an IMDb ID are always removed,
+            "unchanged": Emby IDs of items that stay in the collection, in collection order,
+        }
+    """
+    target_set = set(target_imdb_ids)
+    collection_imdb_ids = set()
+    remove_emby_ids = []
+    unchanged_emby_ids = []
+
+    for item in collection_items:
+        imdb_id = item["Imdb"]
+        if imdb_id is not None and imdb_id in target_set:
+            collection_imdb_ids.add(imdb_id)
+            unchanged_emby_ids.append(item["Id"])
+        else:
+            remove_emby_ids.append(item["Id"])
+
+    add_imdb_ids = [
+        imdb_id
+        for imdb_id in dict.fromkeys(target_imdb_ids)
+        if imdb_id not in collection_imdb_ids
+    ]
+
+    return {
+        "add": add_imdb_ids,
+        "remove": remove_emby_ids,
+        "unchanged": unchanged_emby_ids,
+    }
@@ -1,4 +1,5 @@
 import os
+import json
 import configparser
 
 
@@ -59,3 +60,45 @@ class Db:
 
         with open(self.config_file, "w") as configfile:
             self.config.write(configfile)
+
+
+class JsonDb:
+    """
+    Stores a single JSON document in the temp directory. Used for data that is too large
+    or too nested for the configuration file used by Db.
+    """
+
+    def __init__(self, file_name, temp_dir="temp"):
+        self.temp_dir = temp_dir
+        self.file_path = os.path.join(self.temp_dir, file_name)
+        if not os.path.exists(self.temp_dir):
+            os.makedirs(self.temp_dir)
+
+    def load(self, default=None):
+        """
+        Args:
+            default: Returned if the file does not exist or can not be read.
+
+        Returns:
+            The stored data, or default.
+        """
+        if not os.path.exists(self.file_path):
+            return default
+        try:
+            with open(self.file_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error reading {self.file_path}, starting from scratch: {e}")
+            return default
+
+    def save(self, data):
+        """
+        Writes the data to a temporary file first so a crash never leaves a half written file.
+
+        Args:
+            data: Anything that can be serialized to JSON.
+        """
+        temp_path = self.file_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(temp_path, self.file_path)
@@ -1,9 +1,14 @@
 import os
 import time
-import requests
-import base64
-from urllib.parse import quote
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode
 from datetime import datetime
+from src.http_session import create_session, get_connection_stats
+from src.rate_limiter import RateLimiter
+from src.image_file import Base64FileStream, detect_content_type
+from src.list_output import in_current_context
 
 ## Helpful URLS for dev:
 # https://swagger.emby.media/?staticview=true#/
@@ -13,15 +18,89 @@ from datetime import datetime
 
 
 class Emby:
-
-    def __init__(self, server_url, user_id, api_key):
+    # Query parameters of Items/{id}/Refresh for each profile of refresh_item
+    refresh_profiles = {
+        # Replaces all metadata, images are refreshed the way Emby does by default
+        "replace_all_metadata": {"ReplaceAllMetadata": "true"},
+        # Downloads all metadata and images again
+        "full": {
+            "MetadataRefreshMode": "FullRefresh",
+            "ImageRefreshMode": "FullRefresh",
+            "ReplaceAllMetadata": "true",
+            "ReplaceAllImages": "true",
+        },
+        # Downloads all metadata again, only missing images are downloaded
+        "no_image_replace": {
+            "MetadataRefreshMode": "FullRefresh",
+            "ImageRefreshMode": "Default",
+            "ReplaceAllMetadata": "true",
+            "ReplaceAllImages": "false",
+        },
+        # Downloads all metadata again and leaves images alone
+        "metadata_only": {
+            "MetadataRefreshMode": "FullRefresh",
+            "ImageRefreshMode": "None",
+            "ReplaceAllMetadata": "true",
+            "ReplaceAllImages": "false",
+        },
+        # Only fills in missing metadata and images, existing ratings may not be updated
+        "default": {
+            "MetadataRefreshMode": "Default",
+            "ImageRefreshMode": "Default",
+            "ReplaceAllMetadata": "false",
+            "ReplaceAllImages": "false",
+        },
+    }
+
+    def __init__(
+        self,
+        server_url,
+        user_id,
+        api_key,
+        pool_size=10,
+        timeout=30,
+        max_retries=3,
+        keep_alive=True,
+        rate_limiter=None,
+        page_fetch_workers=4,
+        max_url_length=4096,
+        property_ledger=None,
+        verify_property_ledger=False,
+        collection_write_workers=1,
+    ):
         self.server_url = server_url
         self.user_id = user_id
         self.api_key = api_key
         self.headers = {"X-MediaBrowser-Token": api_key}
-        # To prevent too long URLs, queries are done in batches of n
-        self.api_batch_size = 50
-        self.seconds_between_requests = 1
+        # All requests share one session so connections to Emby are kept alive and reused
+        self.session = create_session(pool_size, max_retries, keep_alive=keep_alive)
+        self.timeout = timeout
+        self.__connection_stats_baseline = get_connection_stats(self.session)
+        # Spaces out requests only when Emby starts struggling, see RateLimiter
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        # Collection name -> ID and ID -> metadata, built once and kept until invalidated
+        self.__collections_by_name = None
+        self.__collections_by_id = None
+        self.__collection_index_lock = threading.RLock()
+        # To prevent too long URLs, queries with many IDs are split into batches whose URL
+        # fits into this many characters. Lowered automatically if Emby rejects a URL,
+        # see reset_max_url_length.
+        self.max_url_length = max_url_length
+        self.configured_max_url_length = max_url_length
+        # Number of pages get_items fetches at the same time once the total count is known
+        self.page_fetch_workers = page_fetch_workers
+        self.collection_page_size = 500
+        # Property updates buffered between start_update_batch and flush_updates, {item_id: {property: value}}
+        self.__pending_updates = None
+        self.__buffered_update_count = 0
+        self.__updates_lock = threading.Lock()
+        # Optional PropertyLedger, set_item_property skips values that were already written
+        self.property_ledger = property_ledger
+        # If True, values the ledger considers unchanged are checked against Emby first
+        self.verify_property_ledger = verify_property_ledger
+        self.__skipped_update_count = 0
+        # Number of add/remove batches sent to a collection at the same time, 1 sends them in order
+        self.collection_write_workers = collection_write_workers
         # get system info to see if it works
         self.system_info = self.get_system_info()
 
@@ -29,7 +108,7 @@ class Emby:
         endpoint = "/emby/System/Info"
         url = self.server_url + endpoint
         try:
-            response = requests.get(url, headers=self.headers)
+            response = self.__request("get", url, headers=self.headers)
             return response.json()
         except Exception as e:
             print(
@@ -40,7 +119,7 @@ class Emby:
     def get_users(self):
         user_list_endpoint = "/emby/Users"
         user_list_url = self.server_url + user_list_endpoint
-        user_list_response = requests.get(user_list_url, headers=self.headers)
+        user_list_response = self.__request("get", user_list_url, headers=self.headers)
         try:
             return user_list_response.json()
         except Exception as e:
@@ -58,39 +137,24 @@ class Emby:
         Returns:
             list: A list of items (movies and series) whose SortName starts with the filter.
         """
-        limit = 50
-        start_index = 0
         filtered_items = []
-        found_sort_name = True
-
-        while found_sort_name:
-
-            items = self.get_items(
-                fields=["SortName"],
-                include_item_types=["Movie", "Series"],
-                sort_by="SortName",
-                limit=limit,
-                start_index=start_index,
-                getAll=False,
-            )
 
+        # Pages are fetched ahead in parallel, the rest are cancelled once a sort name doesn't match
+        for items in self.iter_item_pages(
+            fields=["SortName"],
+            include_item_types=["Movie", "Series"],
+            sort_by="SortName",
+        ):
+            if items is None:
+                break
             for item in items:
-                if item["SortName"].startswith(filter):
-                    filtered_items.append(item)
-                else:
-                    found_sort_name = False
-                    break
-
-            time.sleep(self.seconds_between_requests)
-            start_index += limit
+                if not item["SortName"].startswith(filter):
+                    return filtered_items
+                filtered_items.append(item)
 
         return filtered_items
 
     def get_items_with_imdb_id(self, imdb_ids, item_types=None):
-        batch_size = self.api_batch_size
-        returned_items = []
-        gotten_item_names = []
-
         if item_types is None:
             item_types = ["Movie", "Series"]
         else:
@@ -103,33 +167,11 @@ class Emby:
                 for item_type in item_types
             ]
 
-        for i in range(0, len(imdb_ids), batch_size):
-            batch_imdb_ids = imdb_ids[i : i + batch_size]
-            # Remove any ids from batch_imdb_ids that are None
-            batch_imdb_ids = [
-                imdb_id for imdb_id in batch_imdb_ids if imdb_id is not None
-            ]
-            imdb_ids_str = ",".join(["imdb." + imdb_id for imdb_id in batch_imdb_ids])
-
-            items = self.get_items(
-                params={"AnyProviderIdEquals": imdb_ids_str},
-                fields=["ChildCount", "RecursiveItemCount"],
-                include_item_types=item_types,
-                limit=batch_size,
-            )
-
-            for item in items:
-                if item["Name"] not in gotten_item_names:
-                    returned_items.append(item["Id"])
-                    gotten_item_names.append(item["Name"])
-
-        return returned_items
+        # Remove any ids that are None
+        imdb_ids = [imdb_id for imdb_id in imdb_ids if imdb_id is not None]
+        return self.__get_items_with_provider_ids("imdb", imdb_ids, item_types)
 
     def get_items_with_tvdb_id(self, tvdb_ids, item_types=None):
-        batch_size = self.api_batch_size
-        returned_items = []
-        gotten_item_names = []
-
         if item_types is None:
             item_types = ["Movie", "Series", "Episode"]
         else:
@@ -146,24 +188,102 @@ class Emby:
                 for item_type in item_types
             ]
 
-        for i in range(0, len(tvdb_ids), batch_size):
-            batch_tvdb_ids = tvdb_ids[i : i + batch_size]
-            tvdb_ids_str = ",".join(["tvdb." + tvdb_id for tvdb_id in batch_tvdb_ids])
+        return self.__get_items_with_provider_ids("tvdb", tvdb_ids, item_types)
 
-            items = self.get_items(
-                params={"AnyProviderIdEquals": tvdb_ids_str},
-                fields=["ChildCount", "RecursiveItemCount"],
-                include_item_types=item_types,
-                limit=batch_size,
+    def __get_items_with_provider_ids(self, provider, provider_ids, item_types):
+        # Looks up items with AnyProviderIdEquals in as few requests as the URL length allows
+        returned_items = []
+        gotten_item_names = set()
+        fields = ["ChildCount", "RecursiveItemCount"]
+
+        provider_ids = [f"{provider}.{provider_id}" for provider_id in provider_ids]
+        url, query_params = self.__build_items_query(
+            params={"AnyProviderIdEquals": ""},
+            fields=fields,
+            include_item_types=item_types,
+        )
+        base_length = self.__url_length(url, query_params)
+        separator_length = len(quote(",", safe=""))
+        batches = deque(
+            self.__url_length_batches(provider_ids, base_length, separator_length)
+        )
+
+        while batches:
+            batch = batches.popleft()
+            items, url_too_long = self.__get_items_batch(
+                {"AnyProviderIdEquals": ",".join(batch)}, fields, item_types, len(batch)
             )
 
+            if items is None:
+                if url_too_long and len(batch) > 1:
+                    batches = self.__rebatch(
+                        batch, batches, base_length, separator_length
+                    )
+                    continue
+                print(
+                    f"ERROR: Could not look up a batch of {len(batch)} {provider} IDs"
+                )
+                return None
+
             for item in items:
                 if item["Name"] not in gotten_item_names:
                     returned_items.append(item["Id"])
-                    gotten_item_names.append(item["Name"])
+                    gotten_item_names.add(item["Name"])
+
+        return returned_items
+
+    def get_items_by_ids(self, item_ids: list, fields: list = None):
+        """
+        Retrieves items by their Emby IDs in as few requests as the URL length allows.
+
+        Args:
+            item_ids (list): The IDs of the items.
+            fields (list): List of fields to include in the response. Defaults to None.
+
+        Returns:
+            list: The items that were found, in the order Emby returns them.
+                None if a batch could not be retrieved.
+        """
+        returned_items = []
+        item_ids = [str(item_id) for item_id in item_ids]
+        url, query_params = self.__build_items_query(params={"Ids": ""}, fields=fields)
+        base_length = self.__url_length(url, query_params)
+        separator_length = len(quote(",", safe=""))
+        batches = deque(
+            self.__url_length_batches(item_ids, base_length, separator_length)
+        )
+
+        while batches:
+            batch = batches.popleft()
+            items, url_too_long = self.__get_items_batch(
+                {"Ids": ",".join(batch)}, fields, None, len(batch)
+            )
+
+            if items is None:
+                if url_too_long and len(batch) > 1:
+                    batches = self.__rebatch(
+                        batch, batches, base_length, separator_length
+                    )
+                    continue
+                print(f"ERROR: Could not get a batch of {len(batch)} items by ID")
+                return None
+
+            returned_items += items
 
         return returned_items
 
+    def __get_items_batch(self, params, fields, item_types, batch_size):
+        # Requests one batch of a lookup by IDs in a single page.
+        # Returns the items, or None on error, and whether the URL was too long
+        url, query_params = self.__build_items_query(
+            params=params,
+            fields=fields,
+            include_item_types=item_types,
+            limit=batch_size,
+        )
+        items, _, url_too_long = self.__get_items_page(url, query_params, 0)
+        return items, url_too_long
+
     def get_all_collections(self, include_contents=True):
         """
         Retrieves all collections from the Emby server.
@@ -172,11 +292,11 @@ class Emby:
         - include_contents (bool): Flag to indicate whether to include the items within each collection.
 
         Returns:
-        - collections_list (list): List of dictionaries representing each collection, including its name, ID, and items (if include_contents is True).
+        - collections_list (list): List of dictionaries representing each collection, including its name, ID, child counts and items (if include_contents is True).
         """
         endpoint = f"/emby/users/{self.user_id}/items?Fields=ChildCount,RecursiveItemCount&Recursive=true&IncludeItemTypes=boxset"
         url = self.server_url + endpoint
-        response = requests.get(url, headers=self.headers)
+        response = self.__request("get", url, headers=self.headers)
         try:
             items = response.json()
         except Exception as e:
@@ -194,58 +314,75 @@ class Emby:
                     item["Id"], ["ProviderIds"]
                 )
             collections_list.append(
-                {"Name": item["Name"], "Id": item["Id"], "items": items_in_collection}
+                {
+                    "Name": item["Name"],
+                    "Id": item["Id"],
+                    "ChildCount": item.get("ChildCount"),
+                    "RecursiveItemCount": item.get("RecursiveItemCount"),
+                    "items": items_in_collection,
+                }
             )
 
         return collections_list
 
-    def get_items_in_collection(self, collection_id: int, fields: list = None):
+    def get_items_in_collection(
+        self, collection_id: int, fields: list = None, params: dict = None
+    ):
         """
         Retrieves items in a collection based on the provided collection ID.
+        Queried in pages with only the requested fields and without images and
+        user data, so large collections don't produce huge responses.
 
         Args:
             collection_id (str or int): The ID of the collection.
             fields (list): List of fields to include in the response. Defaults to None.
+            params (dict): Additional filters for the query, e.g. {"MinDateCreated": "2024-01-01T00:00:00Z"}.
 
         Returns:
             list: A list of dictionaries containing the structured items in the collection.
-                Each dictionary contains the specified fields for each item.
+                Each dictionary contains Id, Name, Type, Imdb if ProviderIds was requested
+                and the specified fields for each item.
         """
         if collection_id is None:
             return None
-        endpoint = f"/emby/users/{self.user_id}/items?Parentid={collection_id}"
-        if fields:
-            fields_str = ",".join(fields)
-            endpoint += f"&Fields={fields_str}"
-        url = self.server_url + endpoint
-        response = requests.get(url, headers=self.headers)
-
-        try:
-            items = response.json()
-        except Exception as e:
-            print(
-                f"Error occurred while getting items in collection id {collection_id} using url {url} response was {response}: {e}"
-            )
-            return None
+        fields = fields or []
 
         structured_items = []
-        for item in items["Items"]:
-            add_item = {
-                "Id": item["Id"],
-                "Name": item["Name"],
-                "Type": item["Type"],
-            }
-            if "ProviderIds" in item:
-                # Need special treatment because "Imdb" is sometimes all caps and sometimes not!
-                imdb_id = item["ProviderIds"].get("Imdb") or item["ProviderIds"].get(
-                    "IMDB"
+        for items in self.iter_item_pages(
+            params={
+                **(params or {}),
+                "ParentId": collection_id,
+                "Recursive": "false",
+                "EnableImages": "false",
+                "EnableUserData": "false",
+                "ImageTypeLimit": 0,
+            },
+            fields=fields,
+            limit=self.collection_page_size,
+        ):
+            if items is None:
+                print(
+                    f"Error occurred while getting items in collection id {collection_id}"
                 )
-                add_item["Imdb"] = imdb_id
-
-            for field in fields:
-                add_item[field] = item.get(field)
+                return None
 
-            structured_items.append(add_item)
+            for item in items:
+                add_item = {
+                    "Id": item["Id"],
+                    "Name": item["Name"],
+                    "Type": item["Type"],
+                }
+                if "ProviderIds" in item:
+                    # Need special treatment because "Imdb" is sometimes all caps and sometimes not!
+                    imdb_id = item["ProviderIds"].get("Imdb") or item[
+                        "ProviderIds"
+                    ].get("IMDB")
+                    add_item["Imdb"] = imdb_id
+
+                for field in fields:
+                    add_item[field] = item.get(field)
+
+                structured_items.append(add_item)
         return structured_items
 
     def create_collection(self, collection_name, item_ids) -> bool:
@@ -264,8 +401,9 @@ class Emby:
             print("Can't create collection, no items to add to it.")
             return None
 
-        response = requests.post(
-            f"{self.server_url}/Collections?api_key={self.api_key}&IsLocked=true&Name={quote(collection_name)}&Ids={self.__ids_to_str(item_ids)}"
+        response = self.__request(
+            "post",
+            f"{self.server_url}/Collections?api_key={self.api_key}&IsLocked=true&Name={quote(collection_name)}&Ids={self.__ids_to_str(item_ids)}",
         )
 
         if response.status_code != 200:
@@ -273,7 +411,16 @@ class Emby:
             return None
 
         print(f"Successfully created collection {collection_name}")
-        return response.json()["Id"]
+        collection_id = response.json()["Id"]
+        self.__add_to_collection_index(
+            {
+                "Name": collection_name,
+                "Id": collection_id,
+                "ChildCount": len(item_ids),
+                "RecursiveItemCount": len(item_ids),
+            }
+        )
+        return collection_id
 
     # Not tested and not working for collections.
     def delete_item(self, item_id) -> bool:
@@ -288,7 +435,7 @@ class Emby:
         """
 
         url = f"{self.server_url}/Items?{item_id}&api_key={self.api_key}"
-        response = requests.delete(url)
+        response = self.__request("delete", url)
         if response.status_code == 204:
             return True
         else:
@@ -298,43 +445,182 @@ class Emby:
         endpoint = f"/emby/users/{self.user_id}/items/{item_id}"
         url = self.server_url + endpoint
         try:
-            return requests.get(url, headers=self.headers).json()
+            return self.__request("get", url, headers=self.headers).json()
         except Exception as e:
             print(f"Error occurred while getting item: {e}. URL: {url}.")
             return None
 
     def set_item_property(self, item_id, property_name, property_value):
-        return self.__update_item(item_id, {property_name: property_value})
+        if self.__is_unchanged(item_id, property_name, property_value):
+            with self.__updates_lock:
+                self.__skipped_update_count += 1
+            return True
 
-    def get_collection_id(self, collection_name):
-        all_collections = self.get_all_collections(False)
-        collection_found = False
+        with self.__updates_lock:
+            if self.__pending_updates is not None:
+                self.__pending_updates.setdefault(item_id, {})[
+                    property_name
+                ] = property_value
+                self.__buffered_update_count += 1
+                return True
 
-        for collection in all_collections:
-            if collection_name == collection["Name"]:
-                collection_found = True
-                collection_id = collection["Id"]
-                break
+        response = self.__update_item(item_id, {property_name: property_value})
+        if self.property_ledger is not None:
+            self.property_ledger.save()
+        return response
+
+    def __is_unchanged(self, item_id, property_name, property_value) -> bool:
+        if self.property_ledger is None:
+            return False
+        if not self.property_ledger.is_unchanged(
+            item_id, property_name, property_value
+        ):
+            return False
+        if not self.verify_property_ledger:
+            return True
+
+        # Catches values that were changed in Emby since the script wrote them
+        item = self.get_item(item_id)
+        if item is not None and item.get(property_name) == property_value:
+            return True
+        self.property_ledger.forget(item_id, property_name)
+        return False
 
-        if collection_found is False:
+    def start_update_batch(self):
+        """
+        Buffers set_item_property calls until flush_updates is called. All changes to the
+        same item are merged, so each item is written with one GET and one POST
+        no matter how many of its properties change.
+        """
+        with self.__updates_lock:
+            if self.__pending_updates is None:
+                self.__pending_updates = {}
+                self.__buffered_update_count = 0
+
+    def flush_updates(self) -> dict:
+        """
+        Writes all buffered property updates and stops buffering.
+
+        Returns:
+            dict: {"property_updates": int, "items_updated": int, "requests_saved": int}
+        """
+        with self.__updates_lock:
+            pending_updates = self.__pending_updates or {}
+            property_updates = self.__buffered_update_count
+            skipped_updates = self.__skipped_update_count
+            self.__pending_updates = None
+            self.__buffered_update_count = 0
+            self.__skipped_update_count = 0
+
+        for item_id, data in pending_updates.items():
+            self.__update_item(item_id, data)
+        if self.property_ledger is not None:
+            self.property_ledger.save()
+
+        # Every merged or skipped update saves a GET and a POST, verifying a skip costs a GET
+        requests_saved = 2 * (property_updates - len(pending_updates))
+        requests_saved += skipped_updates * (1 if self.verify_property_ledger else 2)
+        if property_updates > 0 or skipped_updates > 0:
+            print(
+                f"Wrote {property_updates} property updates to {len(pending_updates)} items, "
+                f"skipped {skipped_updates} unchanged values, saved {requests_saved} requests"
+            )
+        return {
+            "property_updates": property_updates,
+            "items_updated": len(pending_updates),
+            "updates_skipped": skipped_updates,
+            "requests_saved": requests_saved,
+        }
+
+    def get_collection_id(self, collection_name):
+        if not self.__ensure_collection_index():
+            return None
+        collection = self.__collections_by_name.get(collection_name)
+        if collection is None:
             return None
+        return collection["Id"]
 
-        return collection_id
+    def get_collection_info(self, collection_id) -> dict:
+        """
+        Returns the cached metadata for a collection: Name, Id, ChildCount and RecursiveItemCount.
+        """
+        if not self.__ensure_collection_index():
+            return None
+        return self.__collections_by_id.get(collection_id)
 
-    def add_to_collection(self, collection_name, item_ids: list) -> int:
-        # Returns the number of items added to the collection
-        return self.__add_remove_from_collection(collection_name, item_ids, "add")
+    def invalidate_collection_index(self):
+        """
+        Forgets the cached collection names and IDs. The index is rebuilt with a single
+        collection listing the next time a collection is looked up. Call at the start of
+        each cycle so collections changed outside the script are picked up.
+        """
+        self.__collections_by_name = None
+        self.__collections_by_id = None
 
-    def delete_from_collection(self, collection_name, item_ids: list) -> int:
-        # Returns the number of items deleted from the collection
-        return self.__add_remove_from_collection(collection_name, item_ids, "delete")
+    def __ensure_collection_index(self) -> bool:
+        # Locked so lists processed at the same time never see a half built index
+        with self.__collection_index_lock:
+            if self.__collections_by_name is not None:
+                return True
+            all_collections = self.get_all_collections(False)
+            if all_collections is None:
+                return False
+            collections_by_name = {}
+            collections_by_id = {}
+            for collection in all_collections:
+                collection.pop("items", None)
+                # If several collections share a name the first one listed wins
+                collections_by_name.setdefault(collection["Name"], collection)
+                collections_by_id[collection["Id"]] = collection
+            self.__collections_by_id = collections_by_id
+            self.__collections_by_name = collections_by_name
+            return True
+
+    def __add_to_collection_index(self, collection: dict):
+        # Only added if the index is built, otherwise it is picked up when it is built
+        with self.__collection_index_lock:
+            if self.__collections_by_name is None:
+                return
+            self.__collections_by_name.setdefault(collection["Name"], collection)
+            self.__collections_by_id[collection["Id"]] = collection
 
-    def refresh_item(self, item_id):
-        # Refreshes metadata for a specific item
-        response = requests.post(
-            f"{self.server_url}/Items/{item_id}/Refresh?api_key={self.api_key}&ReplaceAllMetadata=true"
+    def add_to_collection(
+        self, collection_name, item_ids: list, return_results=False
+    ) -> int:
+        # Returns the number of items added to the collection, or the result of
+        # each batch if return_results is True, see __add_remove_from_collection
+        results = self.__add_remove_from_collection(collection_name, item_ids, "add")
+        return results if return_results else self.__affected_count(results)
+
+    def delete_from_collection(
+        self, collection_name, item_ids: list, return_results=False
+    ) -> int:
+        # Returns the number of items deleted from the collection, or the result of
+        # each batch if return_results is True, see __add_remove_from_collection
+        results = self.__add_remove_from_collection(collection_name, item_ids, "delete")
+        return results if return_results else self.__affected_count(results)
+
+    def refresh_item(self, item_id, profile="replace_all_metadata"):
+        """
+        Refreshes metadata for a specific item.
+
+        Args:
+            item_id (str): The ID of the item.
+            profile (str): One of refresh_profiles. Defaults to "replace_all_metadata",
+                which replaces all metadata and lets Emby decide about images.
+
+        Returns:
+            bool: True if Emby accepted the refresh, False otherwise.
+        """
+        if profile not in self.refresh_profiles:
+            print(
+                f"Error: Unknown refresh profile {profile}, must be one of: {', '.join(self.refresh_profiles)}"
+            )
+            return False
+        response = self.__request(
+            "post",
+            f"{self.server_url}/Items/{item_id}/Refresh?api_key={self.api_key}&{urlencode(self.refresh_profiles[profile])}",
         )
-        time.sleep(self.seconds_between_requests)
         if response.status_code != 204:
             print(f"Error refreshing item {item_id}, response: {response}")
             return False
@@ -350,9 +636,12 @@ class Emby:
         limit=50,
         start_index=0,
         getAll=True,
+        parallel=None,
     ):
         """
         Generic method to retrieve all items from Emby, querying in batches.
+        Once the first batch reports TotalRecordCount, the remaining batches are
+        fetched in parallel and returned in order.
 
         Args:
             params (dict): Additional parameters to include in the query.
@@ -363,10 +652,75 @@ class Emby:
             limit (int): Number of items to query in each batch.
             start_index (int): Index to start querying from.
             getAll (bool): Flag to indicate whether to retrieve all items or just the first batch.
+            parallel (int): Maximum number of batches fetched at the same time. Defaults to page_fetch_workers.
 
         Returns:
             list: All items retrieved from the Emby API.
         """
+        all_items = []
+
+        for items in self.iter_item_pages(
+            params,
+            fields,
+            include_item_types,
+            filters,
+            sort_by,
+            limit,
+            start_index,
+            getAll,
+            parallel,
+        ):
+            if items is None:
+                return None
+            all_items.extend(items)
+
+        return all_items
+
+    def iter_item_pages(
+        self,
+        params=None,
+        fields=None,
+        include_item_types=None,
+        filters=None,
+        sort_by=None,
+        limit=50,
+        start_index=0,
+        getAll=True,
+        parallel=None,
+    ):
+        """
+        Same query as get_items, but yields the items one page at a time as soon as each
+        page arrives instead of collecting all of them first. Use for large scans so memory
+        stays flat and processing can start before the last page is downloaded.
+
+        Example:
+            for items in emby.iter_item_pages(fields=["ProviderIds"], limit=1000):
+                if items is None:
+                    break  # Error, already printed
+                for item in items:
+                    ...
+
+        Args:
+            See get_items.
+
+        Yields:
+            list: The items of the next page, or None if a page could not be retrieved,
+                after which nothing more is yielded.
+        """
+        url, query_params = self.__build_items_query(
+            params, fields, include_item_types, filters, sort_by, limit
+        )
+        yield from self.__iter_pages(url, query_params, start_index, getAll, parallel)
+
+    def __build_items_query(
+        self,
+        params=None,
+        fields=None,
+        include_item_types=None,
+        filters=None,
+        sort_by=None,
+        limit=50,
+    ):
         endpoint = f"/emby/users/{self.user_id}/items"
         query_params = {}
 
@@ -381,39 +735,73 @@ class Emby:
         if sort_by:
             query_params["SortBy"] = sort_by
 
-        query_params["Recursive"] = "true"
+        # Recursive unless the caller asked otherwise, e.g. for the direct children of a collection
+        query_params.setdefault("Recursive", "true")
         query_params["Limit"] = limit
 
-        url = self.server_url + endpoint
-        all_items = []
-
-        while True:
-            print(".", end="", flush=True)
-            time.sleep(self.seconds_between_requests)
-            query_params["StartIndex"] = start_index
-            response = requests.get(url, headers=self.headers, params=query_params)
+        return self.server_url + endpoint, query_params
 
+    def __iter_pages(self, url, query_params, start_index, get_all, parallel=None):
+        """
+        Yields the items of each page in order, or None if a page could not be retrieved.
+        Pages below TotalRecordCount of the first page are known to exist, so up to
+        `parallel` of them are requested at the same time. Past that, pages are
+        requested one at a time until a page is not full.
+        """
+        limit = query_params["Limit"]
+        workers = max(1, self.page_fetch_workers if parallel is None else parallel)
+
+        items, total, _ = self.__get_items_page(url, query_params, start_index)
+        yield items
+        if items is None or not get_all or len(items) < limit:
+            return
+
+        next_index = start_index + limit
+        get_items_page = in_current_context(self.__get_items_page)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
             try:
-                response_data = response.json()
-            except Exception as e:
-                print(
-                    f"Error getting items using URL {url} params {query_params} with response {response.content}. Error: {e}"
-                )
-                return None
-
-            if "Items" in response_data:
-                items = response_data["Items"]
-                all_items.extend(items)
-                if len(items) < limit:
-                    break  # We've retrieved all items
-                start_index += limit
-            else:
-                break  # No more items to retrieve
+                while True:
+                    while len(pending) < workers and (
+                        next_index < total or not pending
+                    ):
+                        pending.append(
+                            executor.submit(
+                                get_items_page, url, query_params, next_index
+                            )
+                        )
+                        next_index += limit
+
+                    items, _, _ = pending.popleft().result()
+                    yield items
+                    if items is None or len(items) < limit:
+                        return
+            finally:
+                # Pages fetched ahead are not needed if the caller stopped early or a page failed
+                for future in pending:
+                    future.cancel()
+
+    def __get_items_page(self, url, query_params, start_index):
+        # Returns the items of one page, TotalRecordCount and whether Emby rejected the URL
+        # as too long. Items and TotalRecordCount are None on error
+        print(".", end="", flush=True)
+        page_params = dict(query_params, StartIndex=start_index)
+        response = self.__request("get", url, headers=self.headers, params=page_params)
 
-            if not getAll:
-                break
+        try:
+            response_data = response.json()
+        except Exception as e:
+            url_too_long = self.__is_url_too_long(response)
+            print(
+                f"Error getting items using URL {url} params {page_params} with response {response.content}. Error: {e}"
+            )
+            return None, None, url_too_long
 
-        return all_items
+        return (
+            response_data.get("Items", []),
+            response_data.get("TotalRecordCount", 0),
+            False,
+        )
 
     def set_item_as_played(self, user_id, item_id, date_played=None):
         """
@@ -454,7 +842,7 @@ class Emby:
             else:
                 params["DatePlayed"] = date_played
 
-        response = requests.post(url, headers=self.headers, params=params)
+        response = self.__request("post", url, headers=self.headers, params=params)
         if response.status_code == 200:
             return True
         else:
@@ -476,7 +864,7 @@ class Emby:
         """
         endpoint = f"/emby/Users/{user_id}/FavoriteItems/{item_id}"
         url = self.server_url + endpoint
-        response = requests.post(url, headers=self.headers)
+        response = self.__request("post", url, headers=self.headers)
         if response.status_code == 200:
             return True
         else:
@@ -540,7 +928,8 @@ class Emby:
         }
 
         try:
-            response = requests.post(
+            response = self.__request(
+                "post",
                 url,
                 headers=self.headers,
                 json=params,
@@ -581,25 +970,28 @@ class Emby:
             return False
 
         try:
-            with open(image_path, "rb") as f:
-                image_data = f.read()
-
-            image_data_base64 = base64.b64encode(image_data)
+            content_type = detect_content_type(image_path)
+            if content_type is None:
+                print(f"Error: Could not detect the image type of {image_path}")
+                return False
 
             endpoint = (
-                f"emby/Items/{item_id}/Images/{image_type}?api_key={self.api_key}"
+                f"/emby/Items/{item_id}/Images/{image_type}?api_key={self.api_key}"
             )
             url = self.server_url + endpoint
             headers = {
-                "Content-Type": "image/jpeg",
+                "Content-Type": content_type,
                 "X-Emby-Token": self.api_key,
             }
 
-            response = requests.post(
-                url,
-                headers=headers,
-                data=image_data_base64,
-            )
+            # The image is base64 encoded while it is sent instead of all at once in memory
+            with Base64FileStream(image_path) as image_data_base64:
+                response = self.__request(
+                    "post",
+                    url,
+                    headers=headers,
+                    data=image_data_base64,
+                )
 
             if response.status_code == 204:
                 return True
@@ -624,11 +1016,13 @@ class Emby:
             f"{self.server_url}/emby/Items/{item_id}?api_key={self.api_key}"
         )
         try:
-            response = requests.post(update_item_url, json=item, headers=self.headers)
-            print(
-                f"Updated item {item_id} with {data}. Waiting {self.seconds_between_requests} seconds."
+            response = self.__request(
+                "post", update_item_url, json=item, headers=self.headers
             )
-            time.sleep(self.seconds_between_requests)
+            print(f"Updated item {item_id} with {data}.")
+            if response.ok and self.property_ledger is not None:
+                for property_name, property_value in data.items():
+                    self.property_ledger.record(item_id, property_name, property_value)
             return response
         except Exception as e:
             print(f"Error occurred while updating item: {e}")
@@ -636,53 +1030,283 @@ class Emby:
 
     def __add_remove_from_collection(
         self, collection_name: str, item_ids: list, operation: str
-    ) -> int:
+    ) -> list:
+        """
+        Adds or removes items in batches whose URL fits into max_url_length.
 
-        affected_count = 0
+        With collection_write_workers above 1 the batches are sent at the same time.
+        Every batch that fails is retried once on its own after the others are done.
+        Emby updates the items of a collection by reading and writing all of them, so
+        batches sent at the same time can undo each other even though each one succeeds.
+        The collection is therefore read again afterwards and the items that were not
+        added or removed are sent again, one batch at a time.
 
+        Returns:
+            list: One dict per batch in the order of item_ids,
+                {"item_ids": [...], "status_code": 204, "success": True}.
+                status_code is None if the request could not be sent.
+        """
         if not item_ids:
-            return affected_count
+            return []
 
         collection_id = self.get_collection_id(collection_name)
 
         if collection_id is None:
-            return affected_count
+            return [{"item_ids": list(item_ids), "status_code": None, "success": False}]
 
-        batch_size = self.api_batch_size
-        num_batches = (len(item_ids) + batch_size - 1) // batch_size
+        method = {"add": "post", "delete": "delete"}[operation]
+        url_without_ids = f"{self.server_url}/Collections/{collection_id}/Items/?api_key={self.api_key}&Ids="
+        batches = list(
+            self.__url_length_batches(item_ids, len(url_without_ids), len(","))
+        )
 
         print(
-            f"Processing {collection_name} with '{operation}' in {num_batches} batches"
+            f"Processing {collection_name} with '{operation}' in {len(batches)} batches"
         )
 
-        for i in range(num_batches):
-            start_index = i * batch_size
-            end_index = min((i + 1) * batch_size, len(item_ids))
-            batch_item_ids = item_ids[start_index:end_index]
-            print(".", end="", flush=True)
+        def send(batch_item_ids):
+            return self.__send_collection_batch(method, url_without_ids, batch_item_ids)
 
-            if operation == "add":
-                response = requests.post(
-                    f"{self.server_url}/Collections/{collection_id}/Items/?api_key={self.api_key}&Ids={self.__ids_to_str(batch_item_ids)}"
-                )
-            elif operation == "delete":
-                response = requests.delete(
-                    f"{self.server_url}/Collections/{collection_id}/Items/?api_key={self.api_key}&Ids={self.__ids_to_str(batch_item_ids)}"
-                )
+        workers = min(self.collection_write_workers, len(batches))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                batch_results = list(executor.map(in_current_context(send), batches))
+        else:
+            batch_results = [send(batch_item_ids) for batch_item_ids in batches]
+
+        results = []
+        for result in (result for results in batch_results for result in results):
+            if not result["success"]:
+                result = self.__retry_collection_batch(method, url_without_ids, result)
+            results.append(result)
+
+        if workers > 1:
+            results = self.__verify_collection_batches(
+                collection_id, operation, method, url_without_ids, results
+            )
 
-            if response.status_code != 204:
+        print()
+        for result in results:
+            if not result["success"]:
                 print(
-                    f"Error processing collection with operation '{operation}', response: {response}"
+                    f"Error processing {len(result['item_ids'])} items in {collection_name} with operation '{operation}', status code: {result['status_code']}"
                 )
-                return affected_count
+        print(
+            f"Finished '{operation}' with {self.__affected_count(results)} of {len(item_ids)} items in {collection_name}"
+        )
 
-            affected_count += len(batch_item_ids)
-            time.sleep(self.seconds_between_requests)
+        return results
 
-        print()
-        print(f"Finished '{operation}' with {len(item_ids)} items in {collection_name}")
+    def __verify_collection_batches(
+        self,
+        collection_id,
+        operation: str,
+        method: str,
+        url_without_ids: str,
+        results: list,
+    ) -> list:
+        # Splits each successful batch into the items that really were added or removed
+        # and the rest, which are sent again
+        collection_items = self.get_items_in_collection(collection_id)
+        if collection_items is None:
+            print(f"Could not check the result of '{operation}' in the collection")
+            return results
+        collection_item_ids = {str(item["Id"]) for item in collection_items}
+
+        verified_results = []
+        for result in results:
+            missed_item_ids = [
+                item_id
+                for item_id in result["item_ids"]
+                if (str(item_id) in collection_item_ids) != (operation == "add")
+            ]
+            if not result["success"] or not missed_item_ids:
+                verified_results.append(result)
+                continue
+
+            print(
+                f"{len(missed_item_ids)} items were overwritten by a concurrent batch, sending them again"
+            )
+            applied_item_ids = [
+                item_id
+                for item_id in result["item_ids"]
+                if item_id not in missed_item_ids
+            ]
+            if applied_item_ids:
+                verified_results.append(dict(result, item_ids=applied_item_ids))
+            verified_results += self.__send_collection_batch(
+                method, url_without_ids, missed_item_ids
+            )
+        return verified_results
+
+    def __send_collection_batch(
+        self, method: str, url_without_ids: str, batch_item_ids: list
+    ) -> list:
+        # Returns a list of batch results, more than one if the URL was too long
+        # and the batch had to be split
+        print(".", end="", flush=True)
+        try:
+            response = self.__request(
+                method, url_without_ids + self.__ids_to_str(batch_item_ids)
+            )
+        except Exception as e:
+            print(f"Error sending collection batch: {e}")
+            return [{"item_ids": batch_item_ids, "status_code": None, "success": False}]
+
+        if self.__is_url_too_long(response) and len(batch_item_ids) > 1:
+            results = []
+            for smaller_batch in self.__rebatch(
+                batch_item_ids, deque(), len(url_without_ids), len(",")
+            ):
+                results += self.__send_collection_batch(
+                    method, url_without_ids, smaller_batch
+                )
+            return results
+
+        return [
+            {
+                "item_ids": batch_item_ids,
+                "status_code": response.status_code,
+                "success": response.status_code == 204,
+            }
+        ]
 
-        return affected_count
+    def __retry_collection_batch(
+        self, method: str, url_without_ids: str, failed_result: dict
+    ) -> dict:
+        # Retries a failed batch once, the batch is not split again
+        print(
+            f"Retrying {len(failed_result['item_ids'])} items, status code: {failed_result['status_code']}"
+        )
+        retried = self.__send_collection_batch(
+            method, url_without_ids, failed_result["item_ids"]
+        )
+        if len(retried) == 1:
+            return retried[0]
+        return {
+            "item_ids": failed_result["item_ids"],
+            "status_code": next(
+                (r["status_code"] for r in retried if not r["success"]),
+                retried[-1]["status_code"],
+            ),
+            "success": all(r["success"] for r in retried),
+        }
+
+    @staticmethod
+    def __affected_count(results: list) -> int:
+        return sum(len(result["item_ids"]) for result in results if result["success"])
+
+    def __request(self, method, url, **kwargs):
+        """
+        Sends a request through the pooled session, paced by the rate limiter.
+        Requests answered with 429 Too Many Requests are retried after backing off.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        max_attempts = self.session.get_adapter(url).max_retries.total + 1
+
+        for attempt in range(max_attempts):
+            if attempt > 0 and hasattr(kwargs.get("data"), "seek"):
+                # A streamed body was consumed by the previous attempt
+                kwargs["data"].seek(0)
+            self.rate_limiter.wait()
+            start_time = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except Exception:
+                self.rate_limiter.record(None, time.monotonic() - start_time)
+                raise
+
+            self.rate_limiter.record(
+                response.status_code,
+                time.monotonic() - start_time,
+                RateLimiter.parse_retry_after(response.headers.get("Retry-After")),
+            )
+            if response.status_code != 429 or attempt == max_attempts - 1:
+                return response
+
+    def get_connection_stats(self, reset=False) -> dict:
+        """
+        Returns how many requests were sent to Emby and how many of them reused an open connection.
+
+        Args:
+            reset (bool): If True, start counting from zero again after returning the stats.
+
+        Returns:
+            dict: {"requests": int, "new_connections": int, "reused_connections": int}
+        """
+        current = get_connection_stats(self.session)
+        stats = {
+            key: current[key] - self.__connection_stats_baseline[key] for key in current
+        }
+        if reset:
+            self.__connection_stats_baseline = current
+        return stats
+
+    def __url_length_batches(self, values, base_length, separator_length) -> list:
+        """
+        Splits values into batches whose comma separated, URL encoded form fits into
+        max_url_length when appended to a URL of base_length characters.
+        """
+        batches = []
+        batch = []
+        length = base_length
+        for value in values:
+            value_length = len(quote(str(value), safe=""))
+            if batch and length + separator_length + value_length > self.max_url_length:
+                batches.append(batch)
+                batch = []
+                length = base_length
+            if batch:
+                length += separator_length
+            batch.append(value)
+            length += value_length
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def reset_max_url_length(self):
+        """
+        Restores the configured max_url_length after it was lowered because Emby rejected
+        a URL, e.g. at the start of a cycle, so one rejected URL doesn't shrink every batch
+        for the life of the process.
+        """
+        self.max_url_length = self.configured_max_url_length
+
+    def __is_url_too_long(self, response) -> bool:
+        """
+        Checks if Emby rejected the request with 414 URI Too Long, and if so lowers
+        max_url_length so the following batches use URLs half as long. Other errors,
+        like a 400 for an invalid ID, don't change the batch size.
+        """
+        if response.status_code != 414:
+            return False
+        url_length = len(response.request.url)
+        max_url_length = max(256, min(self.max_url_length, url_length // 2))
+        if max_url_length < self.max_url_length:
+            self.max_url_length = max_url_length
+            print(f"URL rejected by Emby, max URL length lowered to {max_url_length}")
+        return True
+
+    def __rebatch(self, failed_batch, batches, base_length, separator_length):
+        """
+        Splits the failed batch and the queued batches again with the current max_url_length.
+        The failed batch is at least halved so retries always make progress.
+        """
+        remaining = failed_batch + [value for queued in batches for value in queued]
+        batches = deque(
+            self.__url_length_batches(remaining, base_length, separator_length)
+        )
+        if len(batches[0]) >= len(failed_batch):
+            first_batch = batches.popleft()
+            half = len(failed_batch) // 2
+            batches.appendleft(first_batch[half:])
+            batches.appendleft(first_batch[:half])
+        return batches
+
+    @staticmethod
+    def __url_length(url, query_params) -> int:
+        # Length of the URL requests will send, with room for StartIndex and Limit to grow
+        return len(f"{url}?{urlencode(query_params)}&StartIndex=") + 16
 
     @staticmethod
     def __ids_to_str(ids: list) -> str:
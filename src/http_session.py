@@ -0,0 +1,60 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def create_session(pool_size=10, max_retries=3, backoff_factor=0.5, keep_alive=True):
+    """
+    Creates a requests session that keeps connections alive and reuses them
+    from a pool instead of opening a new TCP/TLS connection for every request.
+
+    Args:
+        pool_size (int): Maximum number of connections kept open per host.
+        max_retries (int): Number of retries on connection errors and 502/503/504 responses.
+            Only idempotent methods (GET, DELETE etc.) are retried on bad status codes.
+        backoff_factor (float): Backoff factor between retries, see urllib3 Retry.
+        keep_alive (bool): If False, connections are closed after each request.
+
+    Returns:
+        requests.Session: The configured session.
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=[502, 503, 504],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+    return session
+
+
+def get_connection_stats(session) -> dict:
+    """
+    Counts requests sent through the session and how many of them needed a new connection.
+
+    Args:
+        session (requests.Session): A session created with create_session.
+
+    Returns:
+        dict: {"requests": int, "new_connections": int, "reused_connections": int}
+    """
+    requests_sent = 0
+    new_connections = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            requests_sent += pool.num_requests
+            new_connections += pool.num_connections
+    return {
+        "requests": requests_sent,
+        "new_connections": new_connections,
+        "reused_connections": max(0, requests_sent - new_connections),
+    }
@@ -0,0 +1,85 @@
+import os
+import base64
+import hashlib
+
+# Read size for hashing and uploading, a multiple of 3 so base64 chunks can be joined
+chunk_size = 3 * 64 * 1024
+
+content_types_by_extension = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".tbn": "image/jpeg",
+    ".png": "image/png",
+}
+
+
+def file_sha256(path: str) -> str:
+    """
+    Returns the SHA-256 hex digest of a file, read in chunks so large images are
+    never loaded into memory at once.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def detect_content_type(path: str) -> str:
+    """
+    Returns the MIME type of an image from its first bytes, falling back to the
+    file extension. Returns None if the type is not supported.
+    """
+    with open(path, "rb") as f:
+        header = f.read(8)
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    return content_types_by_extension.get(os.path.splitext(path)[1].lower())
+
+
+class Base64FileStream:
+    """
+    File-like object that reads a file as base64 while it is being sent, so an image
+    upload does not need the whole file or its encoding in memory.
+
+    The length is known up front, so requests sends a Content-Length header instead of
+    a chunked body. seek(0) starts the stream over for a retried request.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.__file = open(path, "rb")
+        self.__buffer = b""
+        self.__length = 4 * ((os.path.getsize(path) + 2) // 3)
+
+    def __len__(self):
+        return self.__length
+
+    def read(self, size=-1) -> bytes:
+        while size < 0 or len(self.__buffer) < size:
+            chunk = self.__file.read(chunk_size)
+            if not chunk:
+                break
+            self.__buffer += base64.b64encode(chunk)
+        if size < 0:
+            size = len(self.__buffer)
+        data, self.__buffer = self.__buffer[:size], self.__buffer[size:]
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if offset != 0 or whence != os.SEEK_SET:
+            raise ValueError("Base64FileStream can only seek to the start")
+        self.__file.seek(0)
+        self.__buffer = b""
+        return 0
+
+    def close(self):
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,5 +1,6 @@
 from datetime import datetime
 import re
+from src.db import JsonDb
 
 
 class ItemSorting:
@@ -7,14 +8,18 @@ class ItemSorting:
     iterate over categories with sorting required and add sorting name if missing.
     Add all items to a list.
 
-    Then get all items from emby that have a sorting name and check if they are in the above list.
-    If not reset the sorting list.
+    Then check all items that have been given a sorting name, kept in a ledger in
+    temp/sort_name_ledger.json, and reset the sorting name of those not in the above list.
     """
 
-    def __init__(self, emby):
+    def __init__(self, emby, db=None):
         self.emby = emby
-        self.items_ids_with_new_sort_names = []
+        self.items_ids_with_new_sort_names = set()
         self.seconds_between_requests = 1
+        self.db = db if db is not None else JsonDb("sort_name_ledger.json")
+        # {item_id: sort_name} of every item whose sort name has the sorting prefix.
+        # None until loaded, seeded from a library scan if the ledger doesn't exist yet.
+        self.sort_name_ledger = None
 
         # Sort name example: "!!![{time_until_2100}]{previous_sort_name}"
         # Example: "!!![0000000000]The Matrix"
@@ -60,29 +65,52 @@ class ItemSorting:
             print(f"Error: Should not return None for collection {collection_id}")
             return
 
+        ledger = self.__get_ledger()
         for item in items_in_collection:
             # Example item: {'Id': '1541497', 'SortName': 'Elemental', 'DateCreated': '2023-12-08T09:27:58.0000000Z'}
-            self.items_ids_with_new_sort_names.append(item["Id"])
+            self.items_ids_with_new_sort_names.add(item["Id"])
             if self.has_sorting_name(item["SortName"]):
+                ledger[item["Id"]] = item["SortName"]
                 continue
             new_sort_name = f"{self.sort_name_start}{self.minutes_until_2100(item['DateCreated'])}{self.sort_name_end}{item['SortName']}"
             self.emby.set_item_property(item["Id"], "ForcedSortName", new_sort_name)
-
-    def __remove_sort_name(self, item: dict):
-        new_sort_name = re.sub(self.sort_name_regex, "", item["SortName"])
-        self.emby.set_item_property(item["Id"], "ForcedSortName", new_sort_name)
+            ledger[item["Id"]] = new_sort_name
+
+        self.db.save(ledger)
+
+    def __remove_sort_name(self, item_id, sort_name: str):
+        new_sort_name = re.sub(self.sort_name_regex, "", sort_name)
+        self.emby.set_item_property(item_id, "ForcedSortName", new_sort_name)
+
+    def __get_ledger(self) -> dict:
+        if self.sort_name_ledger is not None:
+            return self.sort_name_ledger
+
+        self.sort_name_ledger = self.db.load(default=None)
+        if self.sort_name_ledger is None:
+            # First run with the ledger, find items given a sorting name by earlier versions
+            print("Finding items with custom sort names:")
+            items_with_sort_name = self.emby.get_items_starting_with_sort_name(
+                self.sort_name_start
+            )
+            print()
+            self.sort_name_ledger = {
+                item["Id"]: item["SortName"] for item in items_with_sort_name
+            }
+            self.db.save(self.sort_name_ledger)
+        return self.sort_name_ledger
 
     def reset_items_not_in_custom_sort_categories(self):
         """
-        Get all items from emby that have a sorting name and check if they are in the above list.
-        If not reset the sorting list.
+        Reset the sorting name of items in the ledger that are no longer in any
+        collection with custom sorting. Only those items are touched, the library
+        is not scanned.
         """
-        items_with_sort_name = self.emby.get_items_starting_with_sort_name(
-            self.sort_name_start
-        )
-        print()
-        for item in items_with_sort_name:
-            if item["Id"] not in self.items_ids_with_new_sort_names:
-                self.__remove_sort_name(item)
-
-        self.items_ids_with_new_sort_names = []
+        ledger = self.__get_ledger()
+        for item_id, sort_name in list(ledger.items()):
+            if item_id not in self.items_ids_with_new_sort_names:
+                self.__remove_sort_name(item_id, sort_name)
+                del ledger[item_id]
+
+        self.db.save(ledger)
+        self.items_ids_with_new_sort_names = set()
@@ -0,0 +1,145 @@
+import codecs
+import json
+
+decoder = json.JSONDecoder()
+whitespace = " \t\n\r"
+delimiters = ",]}" + whitespace
+
+
+class JsonStreamError(ValueError):
+    pass
+
+
+class EmptyJsonStream(JsonStreamError):
+    pass
+
+
+class _Reader:
+    """
+    Text buffer over an iterator of byte chunks. Consumed text is dropped, so only
+    the value being parsed and one chunk are held in memory.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def read_more(self) -> bool:
+        if self.eof:
+            return False
+        self.buffer = self.buffer[self.position :]
+        self.position = 0
+        for chunk in self.chunks:
+            text = self.text_decoder.decode(chunk)
+            if text:
+                self.buffer += text
+                return True
+        self.buffer += self.text_decoder.decode(b"", final=True)
+        self.eof = True
+        return True
+
+    def peek(self) -> str:
+        # Returns the next character that is not whitespace, or "" at the end
+        while True:
+            while (
+                self.position < len(self.buffer)
+                and self.buffer[self.position] in whitespace
+            ):
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read_more():
+                return ""
+
+    def expect(self, character: str):
+        if self.peek() != character:
+            raise JsonStreamError(
+                f"Expected {character!r} but found {self.peek()!r} in JSON stream"
+            )
+        self.position += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if self.read_more():
+                    continue
+                raise JsonStreamError("Incomplete or invalid JSON stream")
+            # A number is only complete once a delimiter follows it, e.g. "7." may
+            # continue as "7.5" in the next chunk
+            if (
+                isinstance(value, (int, float))
+                and not isinstance(value, bool)
+                and not self.eof
+                and (end == len(self.buffer) or self.buffer[end] not in delimiters)
+            ):
+                self.read_more()
+                continue
+            self.position = end
+            return value
+
+
+def iter_array_items(chunks, array_keys=None):
+    """
+    Parses JSON from an iterator of byte chunks, e.g. response.iter_content(), and yields
+    the elements of its arrays one at a time, without building the whole document.
+
+    Handles a top-level array, like the /json export of a list, and a top-level object,
+    like {"movies": [...], "shows": [...]} from the list items API. Other values of the
+    object are skipped.
+
+    Args:
+        chunks (iterable): The JSON document as bytes chunks.
+        array_keys (list, optional): Keys of the top-level object whose arrays are read.
+            Defaults to all arrays.
+
+    Yields:
+        tuple: (key, element). key is None for the elements of a top-level array.
+
+    Raises:
+        EmptyJsonStream: If there is no document.
+        JsonStreamError: If the document is not valid JSON or not an array or object.
+    """
+    reader = _Reader(chunks)
+    first = reader.peek()
+    if first == "":
+        raise EmptyJsonStream("Empty JSON stream")
+    if first == "[":
+        yield from ((None, element) for element in _iter_array(reader))
+    elif first == "{":
+        reader.expect("{")
+        if reader.peek() == "}":
+            return
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            if reader.peek() == "[" and (array_keys is None or key in array_keys):
+                yield from ((key, element) for element in _iter_array(reader))
+            else:
+                reader.value()
+            if reader.peek() == ",":
+                reader.expect(",")
+                continue
+            reader.expect("}")
+            return
+    else:
+        raise JsonStreamError(f"Expected a JSON array or object, found {first!r}")
+
+
+def _iter_array(reader):
+    reader.expect("[")
+    if reader.peek() == "]":
+        reader.expect("]")
+        return
+    while True:
+        yield reader.value()
+        if reader.peek() == ",":
+            reader.expect(",")
+            continue
+        reader.expect("]")
+        return
@@ -0,0 +1,67 @@
+import contextvars
+import threading
+
+# Messages of the list being processed in the current context, or None to print directly
+current_buffer = contextvars.ContextVar("current_buffer", default=None)
+
+
+class ListOutput:
+    """
+    Replaces sys.stdout while several lists are processed at the same time. What is printed
+    while a list is processed with capture is collected, and written in one piece with
+    write_block, so the messages and progress dots of a list are not mixed with those of
+    the other lists.
+
+    Work handed to a thread pool only prints to the same list if it runs in the context of
+    the caller, see in_current_context.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.__lock = threading.Lock()
+
+    def write(self, text):
+        buffer = current_buffer.get()
+        if buffer is None:
+            with self.__lock:
+                return self.stream.write(text)
+        buffer.append(text)
+        return len(text)
+
+    def flush(self):
+        if current_buffer.get() is None:
+            self.stream.flush()
+
+    def capture(self, function, *args):
+        """
+        Calls function and collects what it prints.
+
+        Returns:
+            tuple: (what function returned, what it printed)
+        """
+        buffer = []
+        token = current_buffer.set(buffer)
+        try:
+            result = function(*args)
+        except Exception:
+            current_buffer.reset(token)
+            self.write_block("".join(buffer))
+            raise
+        current_buffer.reset(token)
+        return result, "".join(buffer)
+
+    def write_block(self, text):
+        if not text:
+            return
+        with self.__lock:
+            self.stream.write(text)
+            self.stream.flush()
+
+
+def in_current_context(function):
+    """
+    Returns function wrapped to run in a copy of the caller's context, for thread pools,
+    so what it prints goes to the same ListOutput buffer as the caller's messages.
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(function, *args, **kwargs)
@@ -1,11 +1,63 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote
-import requests
+from src.http_session import create_session
+from src.rate_limiter import RateLimiter
+from src.response_cache import ResponseCache
+from src.json_stream import iter_array_items, EmptyJsonStream, JsonStreamError
+from src.list_output import in_current_context
 
 
 class Mdblist:
-
-    def __init__(self, api_key):
+    """
+    Client for the MDBList API.
+
+    All requests share one pooled session. List and lookup responses are kept in an
+    on-disk ResponseCache for cache_ttl_minutes, after that they are revalidated with
+    ETag/Last-Modified where MDBList supports it, so unchanged lists cost a 304 or no
+    request at all. User info and API limits are never cached.
+
+    Attributes:
+        api_key (str): The MDBList API key.
+        session (requests.Session): The session used for all requests.
+        rate_limiter (RateLimiter): Paces the requests, 429 responses are retried.
+        cache (ResponseCache): The response cache, or None if caching is disabled.
+        timeout (int): Seconds to wait for MDBList to respond.
+        request_count (int): Requests sent to MDBList, responses served from the cache are not counted.
+            See start_request_tally for the requests of one list.
+        page_workers (int): Pages of a list requested at the same time, see get_list.
+    """
+
+    # Fields kept from each item of a list when only its IMDb IDs are needed
+    id_fields = ["imdb_id", "mediatype"]
+    # List responses are parsed in chunks of this many bytes while they are read
+    stream_chunk_size = 64 * 1024
+
+    def __init__(
+        self,
+        api_key,
+        cache_ttl_minutes=60,
+        pool_size=10,
+        timeout=60,
+        page_workers=4,
+        rate_limiter=None,
+    ):
         self.api_key = api_key
+        # Pages of a list requested at the same time when its size is known
+        self.page_workers = page_workers
+        self.session = create_session(pool_size)
+        # Lists and their pages are downloaded at the same time, so requests are spaced
+        # out as soon as MDBList answers 429 or struggles, see RateLimiter
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.timeout = timeout
+        self.request_count = 0
+        self.__request_count_lock = threading.Lock()
+        # Tally of the thread between start_request_tally and end_request_tally
+        self.__thread_state = threading.local()
+        self.cache = (
+            ResponseCache(cache_ttl_minutes * 60) if cache_ttl_minutes >= 0 else None
+        )
         self.user_info_url = "https://api.mdblist.com/user/?apikey=" + api_key
         self.my_lists_url = "https://api.mdblist.com/lists/user/?apikey=" + api_key
         self.search_lists_url = (
@@ -25,9 +77,106 @@ class Mdblist:
             "https://api.mdblist.com/lists/{list_id}?apikey=" + api_key
         )
 
+    def __get(self, url, use_cache=True, stream=False):
+        """
+        GET request through the pooled session and the response cache.
+
+        Args:
+            url (str): The URL.
+            use_cache (bool): If False, the response cache is not used.
+            stream (bool): If True and the response is not cached, the body is only
+                downloaded when it is read, e.g. with iter_content.
+
+        Returns:
+            requests.Response or CachedResponse: Both have status_code, headers, text, json() and iter_content().
+        """
+        self.__tally_request()
+        if not use_cache or self.cache is None:
+            self.__count_request()
+            return self.__send(url, stream=stream)
+
+        cached_response = self.cache.get(url)
+        if cached_response is not None and self.cache.is_fresh(cached_response):
+            return cached_response
+
+        self.__count_request()
+        headers = {}
+        if cached_response is not None:
+            headers = self.cache.validation_headers(cached_response)
+
+        response = self.__send(url, headers=headers, stream=True)
+        with response:
+            if response.status_code == 304 and cached_response is not None:
+                return self.cache.touch(url, cached_response)
+            if response.status_code != 200:
+                # Errors are not cached, the body is read before the connection is released
+                response.content
+                return response
+            return self.cache.store(url, response)
+
+    def __send(self, url, **kwargs):
+        """
+        Sends a GET request paced by the rate limiter. Requests answered with
+        429 Too Many Requests are retried after the time given in Retry-After.
+        """
+        max_attempts = self.session.get_adapter(url).max_retries.total + 1
+
+        for attempt in range(max_attempts):
+            self.rate_limiter.wait()
+            start_time = time.monotonic()
+            try:
+                response = self.session.get(url, timeout=self.timeout, **kwargs)
+            except Exception:
+                self.rate_limiter.record(None, time.monotonic() - start_time)
+                raise
+
+            self.rate_limiter.record(
+                response.status_code,
+                time.monotonic() - start_time,
+                RateLimiter.parse_retry_after(response.headers.get("Retry-After")),
+            )
+            if response.status_code != 429 or attempt == max_attempts - 1:
+                return response
+            response.close()
+
+    def __count_request(self):
+        with self.__request_count_lock:
+            self.request_count += 1
+
+    def start_request_tally(self):
+        """
+        Starts counting the requests made by this thread until end_request_tally, including
+        the pages get_list requests in parallel for it. Responses served from the cache are
+        counted too, so the tally is what the requests would cost without the cache.
+        """
+        self.__thread_state.tally = [0]
+
+    def end_request_tally(self) -> int:
+        """
+        Returns:
+            int: The requests counted since start_request_tally.
+        """
+        tally = getattr(self.__thread_state, "tally", None)
+        self.__thread_state.tally = None
+        return tally[0] if tally is not None else 0
+
+    def __tally_request(self):
+        tally = getattr(self.__thread_state, "tally", None)
+        if tally is not None:
+            with self.__request_count_lock:
+                tally[0] += 1
+
+    def __get_list_page_for_tally(self, tally, *args):
+        # Runs a page request in a worker thread, counted in the tally of the calling thread
+        self.__thread_state.tally = tally
+        try:
+            return self.__get_list_page(*args)
+        finally:
+            self.__thread_state.tally = None
+
     def get_user_info(self):
         try:
-            response = requests.get(self.user_info_url)
+            response = self.__get(self.user_info_url, use_cache=False)
             user_info = response.json()
             return user_info
         except Exception as e:
@@ -50,6 +199,8 @@ class Mdblist:
         limit=None,
         offset=None,
         max_items=None,  # <-- Added max_items parameter
+        total_items=None,
+        fields=None,
     ):
         """
         Retrieves a list of items from a specified list ID and optionally filters by IMDb IDs.
@@ -62,49 +213,77 @@ class Mdblist:
             limit (int, optional): Number of items per request. Defaults to None (fetch all).
             offset (int, optional): Offset for pagination. Defaults to None.
             max_items (int, optional): Maximum number of items to retrieve. Defaults to None (fetch all).
+            total_items (int, optional): Number of items in the list, e.g. "items" from get_my_lists.
+                If given, the pages are requested at the same time. Defaults to None.
+            fields (list, optional): If filter_imdb_ids is False, only these fields of each item are kept,
+                e.g. ["imdb_id", "mediatype", "id", "tvdb_id"] where "id" is the TMDb ID. Defaults to None (all fields).
 
         Returns:
             tuple: (list of IMDb IDs or items, list of media types)
         """
+        # Responses are parsed while they are read and only these fields are kept
+        page_fields = self.id_fields if filter_imdb_ids else fields
         all_items = []
         current_offset = offset if offset is not None else 0
         page_limit = limit if limit is not None else 1000
 
-        while True:
-            url = self.items_url.format(list_id=list_id)
-            params = []
-            if append_to_response:
-                params.append(f"append_to_response={'%2C'.join(append_to_response)}")
-            params.append(f"limit={page_limit}")
-            params.append(f"offset={current_offset}")
-            if params:
-                url = f"{url}&{'&'.join(params)}"
-
-            response = requests.get(url)
-            if not response.text:
-                print(f"No response received from {url}")
-                return None, None
-
-            try:
-                result = response.json()
-                items = result.get("movies", []) + result.get("shows", [])
-            except Exception:
-                print(f"Error! Cannot decode json, make sure URL is valid: {url}")
+        if total_items:
+            last_offset = total_items
+            if max_items is not None:
+                last_offset = min(last_offset, current_offset + max_items)
+            offsets = list(range(current_offset, last_offset, page_limit))
+            if len(offsets) > 1:
+                tally = getattr(self.__thread_state, "tally", None)
+                with ThreadPoolExecutor(
+                    max_workers=min(self.page_workers, len(offsets))
+                ) as executor:
+                    pages = list(
+                        executor.map(
+                            in_current_context(
+                                lambda page_offset: self.__get_list_page_for_tally(
+                                    tally,
+                                    list_id,
+                                    append_to_response,
+                                    page_limit,
+                                    page_offset,
+                                    page_fields,
+                                )
+                            ),
+                            offsets,
+                        )
+                    )
+                for items, has_more in pages:
+                    if items is None:
+                        return None, None
+                    all_items.extend(items)
+                # The list may have grown since its size was reported
+                current_offset = offsets[-1] + page_limit
+                if not has_more or (
+                    max_items is not None and len(all_items) >= max_items
+                ):
+                    current_offset = None
+
+        while current_offset is not None:
+            items, has_more = self.__get_list_page(
+                list_id, append_to_response, page_limit, current_offset, page_fields
+            )
+            if items is None:
                 return None, None
 
             all_items.extend(items)
 
             # If max_items is set and we've reached/exceeded it, break
             if max_items is not None and len(all_items) >= max_items:
-                all_items = all_items[:max_items]
                 break
 
             # Check if more pages are available
-            has_more = response.headers.get("X-Has-More", "false").lower() == "true"
             if not has_more:
                 break
             current_offset += page_limit
 
+        if max_items is not None:
+            all_items = all_items[:max_items]
+
         if filter_imdb_ids is False:
             return all_items, self.check_list_mediatype(all_items)
 
@@ -119,6 +298,62 @@ class Mdblist:
             print(f"ERROR! Cannot find any items in list id {list_id}.")
         return imdb_ids, self.check_list_mediatype(all_items)
 
+    def __get_list_page(self, list_id, append_to_response, limit, offset, fields):
+        # Returns (items, has_more), or (None, None) on error
+        url = self.items_url.format(list_id=list_id)
+        params = []
+        if append_to_response:
+            params.append(f"append_to_response={'%2C'.join(append_to_response)}")
+        params.append(f"limit={limit}")
+        params.append(f"offset={offset}")
+        url = f"{url}&{'&'.join(params)}"
+
+        items, headers = self.__get_items(url, ["movies", "shows"], fields)
+        if items is None:
+            return None, None
+        # Movies first, then shows, whatever order they have in the response
+        items = items.get("movies", []) + items.get("shows", [])
+
+        has_more = headers.get("X-Has-More", "false").lower() == "true"
+        return items, has_more
+
+    def __get_items(self, url, array_keys, fields):
+        """
+        Downloads a JSON list of items and parses it while it is read, so only the
+        requested fields of each item are ever held in memory, not the whole response.
+
+        Args:
+            url (str): The URL.
+            array_keys (list): Keys of the arrays to read if the response is an object.
+            fields (list): Fields to keep from each item, None keeps all fields. Items
+                without an imdb_id are kept whole so they can be reported.
+
+        Returns:
+            tuple: ({key: [items]}, response headers). key is None if the response is an array.
+                (None, None) if the response is empty or not valid JSON.
+        """
+        response = self.__get(url, stream=True)
+        items = {}
+        try:
+            with response:
+                for key, item in iter_array_items(
+                    response.iter_content(self.stream_chunk_size), array_keys
+                ):
+                    if (
+                        fields is not None
+                        and isinstance(item, dict)
+                        and "imdb_id" in item
+                    ):
+                        item = {field: item[field] for field in fields if field in item}
+                    items.setdefault(key, []).append(item)
+        except EmptyJsonStream:
+            print(f"No response received from {url}")
+            return None, None
+        except JsonStreamError:
+            print(f"Error! Cannot decode json, make sure URL is valid: {url}")
+            return None, None
+        return items, response.headers
+
     def get_list_using_url(self, url):
         # Just append /json to end of url to get the json version of the list
         # Check first if json is already in the url
@@ -131,23 +366,21 @@ class Mdblist:
 
         url = url + "/json"
 
-        response = requests.get(url)
-        if response.text:
-            lst = response.json()
-            imdb_ids = []
-            for item in lst:
-                if "imdb_id" in item:
-                    imdb_ids.append(item["imdb_id"])
-                else:
-                    print(f"Could not find imdb_id in item {item}.")
-            if len(imdb_ids) == 0:
-                print(
-                    f"ERROR! Cannot find any items in list with api url {url} and public url {url.replace('/json','')}."
-                )
-            return imdb_ids, self.check_list_mediatype(lst)
-        else:
-            print(f"No response received from {url}")
+        items, _ = self.__get_items(url, None, self.id_fields)
+        if items is None:
             return None, None
+        lst = items.get(None, [])
+        imdb_ids = []
+        for item in lst:
+            if "imdb_id" in item:
+                imdb_ids.append(item["imdb_id"])
+            else:
+                print(f"Could not find imdb_id in item {item}.")
+        if len(imdb_ids) == 0:
+            print(
+                f"ERROR! Cannot find any items in list with api url {url} and public url {url.replace('/json','')}."
+            )
+        return imdb_ids, self.check_list_mediatype(lst)
 
     def get_list_items_using_url(self, url):
         # Just append /json to end of url to get the json version of the list
@@ -161,7 +394,7 @@ class Mdblist:
         if url.endswith("/"):
             url = url[:-1]
         url = url + "/json"
-        response = requests.get(url)
+        response = self.__get(url)
         if response.text:
             list = response.json()
             """
@@ -181,7 +414,7 @@ class Mdblist:
     def get_my_lists(self) -> list:
         # Example return
         # [{"id": 45811, "name": "Trending Movies", "slug": "trending-movies", "items": 20, "likes": null, "dynamic": true, "private": false, "mediatype": "movie", "description": ""}]
-        response = requests.get(self.my_lists_url)
+        response = self.__get(self.my_lists_url)
         lst = response.json()
         return lst
 
@@ -209,7 +442,7 @@ class Mdblist:
         ]
         """
         url = self.search_lists_url.format(list_name=quote(list_name))
-        response = requests.get(url)
+        response = self.__get(url)
         lists = response.json()
         return lists
 
@@ -249,7 +482,7 @@ class Mdblist:
 
         """
         url = self.get_lists_of_user_url.format(id=user_id)
-        response = requests.get(url)
+        response = self.__get(url)
         lists = response.json()
         return lists
 
@@ -276,7 +509,7 @@ class Mdblist:
             ...
         ]
         """
-        response = requests.get(self.top_lists_url)
+        response = self.__get(self.top_lists_url)
         top_lists = response.json()
         return top_lists
 
@@ -305,7 +538,7 @@ class Mdblist:
         ]
         """
         url = self.search_lists_url.format(query=quote(query))
-        response = requests.get(url)
+        response = self.__get(url)
         search_results = response.json()
         return search_results
 
@@ -337,7 +570,7 @@ class Mdblist:
         ]
         """
         url = self.get_list_by_name_url.format(username=username, listname=listname)
-        response = requests.get(url)
+        response = self.__get(url)
         list_details = response.json()
         return list_details
 
@@ -367,7 +600,7 @@ class Mdblist:
         ]
         """
         url = self.get_list_by_id_url.format(list_id=list_id)
-        response = requests.get(url)
+        response = self.__get(url)
         list_info = response.json()
 
         if isinstance(list_info, dict):
@@ -426,7 +659,7 @@ class Mdblist:
         }
         """
         url = f"https://api.mdblist.com/user?apikey={self.api_key}"
-        response = requests.get(url)
+        response = self.__get(url, use_cache=False)
         if response.status_code == 200:
             return response.json()
         else:
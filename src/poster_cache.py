@@ -0,0 +1,100 @@
+import hashlib
+from src.db import JsonDb
+from src.http_session import create_session
+from src.image_file import chunk_size, file_sha256
+
+
+class PosterCache:
+    """
+    Remembers the content of the poster last uploaded to each collection, so a poster is
+    only uploaded again when the image itself changes, not when a config is reloaded or
+    the file is moved or renamed.
+
+    Local posters are identified by the SHA-256 of the file. Remote posters are downloaded
+    and hashed, with the ETag and Last-Modified headers of the last download sent along so
+    an unchanged image is answered with 304 Not Modified instead of the image.
+    Stored in temp/poster_cache.json.
+
+    Attributes:
+        entries (dict): {collection_id: {"path": str, "sha256": str, "etag": str, "last_modified": str}}
+    """
+
+    def __init__(self, db=None, session=None, timeout=30):
+        self.db = db if db is not None else JsonDb("poster_cache.json")
+        self.session = session if session is not None else create_session()
+        self.timeout = timeout
+        self.entries = self.db.load(default={})
+
+    def get(self, collection_id):
+        return self.entries.get(str(collection_id))
+
+    def fingerprint(self, collection_id, poster_path: str):
+        """
+        Identifies the current content of a poster.
+
+        Args:
+            collection_id (str): The collection the poster is for. Used to send the
+                validators of the last download of the same URL.
+            poster_path (str): Local path or URL of the poster.
+
+        Returns:
+            dict: {"path", "sha256", "etag", "last_modified"},
+                or None if the poster could not be read or downloaded.
+        """
+        if poster_path.startswith("http"):
+            return self.__remote_fingerprint(self.get(collection_id), poster_path)
+
+        try:
+            sha256 = file_sha256(poster_path)
+        except OSError as e:
+            print(f"Error reading poster {poster_path}: {e}")
+            return None
+        return {
+            "path": poster_path,
+            "sha256": sha256,
+            "etag": None,
+            "last_modified": None,
+        }
+
+    def is_uploaded(self, collection_id, fingerprint: dict) -> bool:
+        # True if the poster with this content is the one last uploaded to the collection
+        entry = self.get(collection_id)
+        return entry is not None and entry["sha256"] == fingerprint["sha256"]
+
+    def record(self, collection_id, fingerprint: dict):
+        if self.get(collection_id) == fingerprint:
+            return
+        self.entries[str(collection_id)] = fingerprint
+        self.db.save(self.entries)
+
+    def __remote_fingerprint(self, entry, url: str):
+        headers = {}
+        if entry is not None and entry["path"] == url:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            with self.session.get(
+                url, headers=headers, stream=True, timeout=self.timeout
+            ) as response:
+                if response.status_code == 304 and headers:
+                    return dict(entry)
+                if response.status_code != 200:
+                    print(f"Error downloading poster {url}, response: {response}")
+                    return None
+
+                sha256 = hashlib.sha256()
+                for chunk in response.iter_content(chunk_size):
+                    sha256.update(chunk)
+
+                return {
+                    "path": url,
+                    "sha256": sha256.hexdigest(),
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }
+        except Exception as e:
+            print(f"Error downloading poster {url}: {e}")
+            return None
@@ -0,0 +1,52 @@
+import threading
+from src.db import JsonDb
+
+
+class PropertyLedger:
+    """
+    Remembers the last value the script wrote to each item property, so values that
+    have not changed since the last write are not written to Emby again.
+    Stored in temp/property_ledger.json.
+
+    Attributes:
+        values (dict): {item_id: {property_name: value}}
+    """
+
+    def __init__(self, db=None):
+        self.db = db if db is not None else JsonDb("property_ledger.json")
+        self.values = self.db.load(default={})
+        self.__changed = False
+        self.__lock = threading.Lock()
+
+    def is_unchanged(self, item_id, property_name, property_value) -> bool:
+        """
+        Returns True if property_value is what was last written to the property.
+        """
+        with self.__lock:
+            item_values = self.values.get(str(item_id), {})
+            return (
+                property_name in item_values
+                and item_values[property_name] == property_value
+            )
+
+    def record(self, item_id, property_name, property_value):
+        with self.__lock:
+            self.values.setdefault(str(item_id), {})[property_name] = property_value
+            self.__changed = True
+
+    def forget(self, item_id, property_name):
+        with self.__lock:
+            item_values = self.values.get(str(item_id), {})
+            if property_name in item_values:
+                del item_values[property_name]
+                self.__changed = True
+
+    def save(self):
+        """
+        Writes the ledger to disk if anything was recorded or forgotten since the last save.
+        """
+        with self.__lock:
+            if not self.__changed:
+                return
+            self.db.save(self.values)
+            self.__changed = False
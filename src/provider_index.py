@@ -0,0 +1,235 @@
+from datetime import datetime, timedelta, timezone
+from src.db import JsonDb
+
+
+class ProviderIndex:
+    """
+    Index from provider IDs (IMDb, TMDb, TVDb) to Emby items.
+
+    Built with one paged scan of all movies and series in the library, so IDs from
+    MDBList lists can be resolved to Emby item IDs locally instead of with
+    AnyProviderIdEquals queries for every list.
+
+    The indexed items are stored in temp/provider_index.json. After a restart only items
+    saved in Emby since the last update are fetched (MinDateLastSaved), and a full scan
+    is done every full_scan_hours to drop items that were deleted from Emby.
+
+    Attributes:
+        emby (object): An instance of the Emby class.
+        full_scan_hours (int): Hours between full scans of the library.
+        items (dict): {emby_id: {"Name": "The Matrix", "Type": "Movie", "ProviderIds": {"imdb": "tt0133093"}}}
+        index (dict): {"imdb": {"tt0133093": [("1541497", "Movie")]}, "tmdb": {...}, "tvdb": {...}}
+            or None if the index has not been built.
+    """
+
+    providers = ["imdb", "tmdb", "tvdb"]
+    item_types = ["Movie", "Series"]
+    page_size = 1000
+    # Items saved this long before the last update are fetched again, in case
+    # the clocks of Emby and the script are not in sync
+    sync_overlap = timedelta(hours=1)
+    date_format = "%Y-%m-%dT%H:%M:%SZ"
+
+    def __init__(self, emby, full_scan_hours=24, db=None):
+        self.emby = emby
+        self.full_scan_hours = full_scan_hours
+        self.db = db if db is not None else JsonDb("provider_index.json")
+        self.items = None
+        self.index = None
+        self.last_update = None
+        self.last_full_scan = None
+
+    def is_built(self) -> bool:
+        return self.index is not None
+
+    def build(self) -> bool:
+        """
+        Brings the index up to date. Loads it from disk the first time, then either fetches
+        the items saved since the last update or scans the whole library if a full
+        scan is due.
+
+        Returns:
+            bool: True if the index is up to date, False if the items could not be retrieved.
+        """
+        if self.items is None:
+            self.__load()
+
+        update_start = datetime.now(timezone.utc)
+        if self.__full_scan_due(update_start):
+            updated = self.__full_scan()
+            if updated:
+                self.last_full_scan = update_start
+        else:
+            updated = self.__incremental_update()
+
+        if not updated:
+            print(
+                "Error: Could not index provider IDs, items will be looked up per list."
+            )
+            self.index = None
+            return False
+
+        self.last_update = update_start
+        self.__rebuild_index()
+        self.__save()
+        return True
+
+    def add_item(self, item: dict):
+        """
+        Adds or replaces an Emby item with "Id", "Name", "Type" and "ProviderIds" in the index.
+        """
+        provider_ids = {}
+        for key, value in (item.get("ProviderIds") or {}).items():
+            # Provider keys are not consistently cased, e.g. "Imdb" and "IMDB"
+            provider = key.lower()
+            if provider in self.providers and value:
+                provider_ids[provider] = str(value)
+
+        if self.index is not None and item["Id"] in self.items:
+            self.__remove_from_index(item["Id"])
+
+        self.items[item["Id"]] = {
+            "Name": item.get("Name"),
+            "Type": item["Type"],
+            "ProviderIds": provider_ids,
+        }
+        if self.index is not None:
+            self.__add_to_index(item["Id"])
+
+    def resolve(self, provider: str, provider_ids: list, item_types: list = None):
+        """
+        Resolves provider IDs to Emby item IDs using the index.
+
+        Args:
+            provider (str): "imdb", "tmdb" or "tvdb".
+            provider_ids (list): The provider IDs to resolve. None entries are ignored.
+            item_types (list, optional): Only return items of these types. Accepts Emby types
+                and MDBList mediatypes ("movie", "show"). Defaults to all indexed types.
+
+        Returns:
+            list: Emby item IDs in the order of provider_ids, or None if the index has not
+                been built. Like get_items_with_imdb_id, only the first item with a given
+                name is returned, so a movie in two libraries is only added once.
+        """
+        if self.index is None:
+            return None
+
+        allowed_types = None
+        if item_types:
+            allowed_types = {self.__to_emby_type(item_type) for item_type in item_types}
+
+        provider_index = self.index[provider.lower()]
+        emby_ids = []
+        seen_names = set()
+        for provider_id in provider_ids:
+            if provider_id is None:
+                continue
+            for emby_id, item_type in provider_index.get(str(provider_id), []):
+                if allowed_types is not None and item_type not in allowed_types:
+                    continue
+                name = self.items[emby_id]["Name"]
+                if name not in seen_names:
+                    seen_names.add(name)
+                    emby_ids.append(emby_id)
+        return emby_ids
+
+    def __full_scan_due(self, now) -> bool:
+        if self.last_full_scan is None or self.last_update is None:
+            return True
+        return now - self.last_full_scan >= timedelta(hours=self.full_scan_hours)
+
+    def __full_scan(self) -> bool:
+        print("Indexing provider IDs of all movies and series in Emby")
+        previous_items = self.items
+        self.items = {}
+        self.index = None
+        for items in self.emby.iter_item_pages(
+            fields=["ProviderIds"],
+            include_item_types=self.item_types,
+            limit=self.page_size,
+        ):
+            if items is None:
+                print()
+                self.items = previous_items
+                return False
+            for item in items:
+                self.add_item(item)
+
+        print()
+        print(f"Indexed provider IDs of {len(self.items)} items")
+        return True
+
+    def __incremental_update(self) -> bool:
+        min_date_last_saved = self.last_update - self.sync_overlap
+        print(
+            f"Updating provider ID index with items saved in Emby since {min_date_last_saved.strftime(self.date_format)}"
+        )
+        updated_count = 0
+        for items in self.emby.iter_item_pages(
+            params={"MinDateLastSaved": min_date_last_saved.strftime(self.date_format)},
+            fields=["ProviderIds"],
+            include_item_types=self.item_types,
+            limit=self.page_size,
+        ):
+            if items is None:
+                print()
+                return False
+            for item in items:
+                self.add_item(item)
+            updated_count += len(items)
+
+        print()
+        print(f"Updated {updated_count} items, {len(self.items)} items indexed")
+        return True
+
+    def __rebuild_index(self):
+        self.index = {provider: {} for provider in self.providers}
+        for emby_id in self.items:
+            self.__add_to_index(emby_id)
+
+    def __add_to_index(self, emby_id):
+        item = self.items[emby_id]
+        for provider, provider_id in item["ProviderIds"].items():
+            entries = self.index[provider].setdefault(provider_id, [])
+            if (emby_id, item["Type"]) not in entries:
+                entries.append((emby_id, item["Type"]))
+
+    def __remove_from_index(self, emby_id):
+        item = self.items[emby_id]
+        for provider, provider_id in item["ProviderIds"].items():
+            entries = self.index[provider].get(provider_id, [])
+            self.index[provider][provider_id] = [
+                entry for entry in entries if entry[0] != emby_id
+            ]
+
+    def __load(self):
+        data = self.db.load(default={})
+        self.items = data.get("items", {})
+        self.last_update = self.__parse_date(data.get("last_update"))
+        self.last_full_scan = self.__parse_date(data.get("last_full_scan"))
+        # Indexes saved before names were stored need a full scan
+        if any("Name" not in item for item in self.items.values()):
+            self.last_full_scan = None
+
+    def __save(self):
+        self.db.save(
+            {
+                "last_update": self.last_update.strftime(self.date_format),
+                "last_full_scan": self.last_full_scan.strftime(self.date_format),
+                "items": self.items,
+            }
+        )
+
+    @classmethod
+    def __parse_date(cls, value):
+        if value is None:
+            return None
+        return datetime.strptime(value, cls.date_format).replace(tzinfo=timezone.utc)
+
+    @staticmethod
+    def __to_emby_type(item_type: str) -> str:
+        if item_type.lower() in ["tv", "show"]:
+            return "Series"
+        if item_type.lower() == "movie":
+            return "Movie"
+        return item_type
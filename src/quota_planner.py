@@ -0,0 +1,179 @@
+import math
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from src.db import JsonDb
+
+
+class QuotaPlanner:
+    """
+    Spreads the daily MDBList API request limit evenly over the cycles of a day.
+
+    At the start of a cycle the remaining requests are read with Mdblist.get_my_limits
+    and divided by the number of cycles left until the limit resets at midnight UTC.
+    Lists are scheduled in order of when they were last downloaded, longest ago first,
+    as long as their estimated cost fits into the budget of the cycle. The other lists
+    are deferred to a later cycle. Lists whose collection is outside its active period
+    are not downloaded, so they are always scheduled and cost nothing. When each list was
+    last downloaded and how many requests it needed are stored in temp/quota_planner.json.
+
+    The cost of a list with a known number of items, like the lists from get_my_lists, is
+    estimated as one request per 1000 items (page_size), plus one request to look up lists
+    configured by name. Other lists are estimated with the requests they needed the last
+    time they were downloaded, see Mdblist.start_request_tally, or one request per source
+    URL or list ID if they were never downloaded. Responses served from the MDBList cache
+    cost nothing, so apart from lists that were never downloaded or have grown since, the
+    estimate is an upper bound.
+
+    Attributes:
+        mdblist (object): An instance of the Mdblist class.
+        hours_between_refresh (int): Hours between cycles, 0 if the script only runs once.
+        budget (int): Requests this cycle may use, or None if the limit is unknown.
+        lists (dict): {collection_name: {"last_fetched": unix time, "requests": int}}
+    """
+
+    page_size = 1000
+
+    def __init__(self, mdblist, hours_between_refresh, db=None):
+        self.mdblist = mdblist
+        self.hours_between_refresh = hours_between_refresh
+        self.db = db if db is not None else JsonDb("quota_planner.json")
+        self.lists = {
+            name: entry if isinstance(entry, dict) else {"last_fetched": entry}
+            for name, entry in self.db.load(default={}).items()
+        }
+        self.budget = None
+        self.remaining = None
+        self.planned_cost = 0
+        self.deferred_count = 0
+        self.__request_count_at_start = 0
+        self.__lock = threading.Lock()
+
+    def start_cycle(self):
+        """
+        Reads the remaining requests of the day and sets the budget of this cycle.
+        """
+        self.__request_count_at_start = self.mdblist.request_count
+        self.planned_cost = 0
+        self.deferred_count = 0
+        self.budget = None
+        self.remaining = None
+
+        limits = self.mdblist.get_my_limits()
+        if not limits or "api_requests" not in limits:
+            print("Could not get MDBList API limits, lists are not limited this cycle")
+            return
+
+        self.remaining = max(
+            0, limits["api_requests"] - limits.get("api_requests_count", 0)
+        )
+        cycles_left = self.__cycles_left_today()
+        self.budget = self.remaining // cycles_left
+        print(
+            f"MDBList API requests: {self.remaining} of {limits['api_requests']} left today, "
+            f"budget {self.budget} for this cycle ({cycles_left} cycles left today)"
+        )
+
+    def plan(self, mdblist_lists: list, is_active=None) -> list:
+        """
+        Picks the lists to download this cycle.
+
+        Args:
+            mdblist_lists (list): The lists, see get_hardcoded_lists in app.py.
+            is_active (callable, optional): Returns False for a list whose collection is
+                outside its active period. Such lists are always scheduled. Defaults to None
+                (all lists are active).
+
+        Returns:
+            list: The lists that fit into the budget, in their original order.
+        """
+        active = [
+            index
+            for index, mdblist_list in enumerate(mdblist_lists)
+            if is_active is None or is_active(mdblist_list)
+        ]
+        if self.budget is None:
+            self.planned_cost = sum(
+                self.estimate_cost(mdblist_lists[index]) for index in active
+            )
+            return mdblist_lists
+
+        by_staleness = sorted(
+            active,
+            key=lambda index: self.lists.get(mdblist_lists[index]["name"], {}).get(
+                "last_fetched", 0
+            ),
+        )
+        scheduled = set(range(len(mdblist_lists))) - set(active)
+        scheduled_active = False
+        for index in by_staleness:
+            mdblist_list = mdblist_lists[index]
+            cost = self.estimate_cost(mdblist_list)
+            fits = self.planned_cost + cost <= self.budget
+            # The stalest list is downloaded even if it is larger than one cycle's
+            # budget, as long as there are requests left today, so it is never stuck
+            if fits or (not scheduled_active and cost <= self.remaining):
+                scheduled.add(index)
+                scheduled_active = True
+                self.planned_cost += cost
+            else:
+                self.deferred_count += 1
+                print(
+                    f"Deferring {mdblist_list['name']} to a later cycle, it needs about {cost} MDBList API requests"
+                )
+
+        return [lst for index, lst in enumerate(mdblist_lists) if index in scheduled]
+
+    def estimate_cost(self, mdblist_list: dict) -> int:
+        # Lists from get_my_lists and list lookups include the number of items
+        items = mdblist_list.get("items")
+        if not items:
+            requests = self.lists.get(mdblist_list["name"], {}).get("requests")
+            if requests:
+                return requests
+        pages = max(1, math.ceil((items or 0) / self.page_size))
+        if mdblist_list.get("id") is not None:
+            return pages
+        if mdblist_list.get("mdblist_name") and mdblist_list.get("user_name"):
+            return pages + 1
+        source = (mdblist_list.get("source") or "").replace(" ", "")
+        if source:
+            return pages * len(source.split(",http"))
+        return 0
+
+    def record_fetched(self, mdblist_list: dict, requests: int):
+        """
+        Records that a list was downloaded.
+
+        Args:
+            mdblist_list (dict): The list.
+            requests (int): The requests the download needed, see Mdblist.end_request_tally.
+        """
+        with self.__lock:
+            self.lists[mdblist_list["name"]] = {
+                "last_fetched": time.time(),
+                "requests": requests,
+            }
+
+    def end_cycle(self):
+        """
+        Saves when the lists were downloaded and logs the requests used this cycle.
+        """
+        with self.__lock:
+            self.db.save(self.lists)
+        used = self.mdblist.request_count - self.__request_count_at_start
+        budget = "unlimited" if self.budget is None else self.budget
+        print(
+            f"MDBList API requests this cycle: {used} used, {self.planned_cost} estimated for lists, "
+            f"budget {budget}, {self.deferred_count} lists deferred"
+        )
+
+    def __cycles_left_today(self) -> int:
+        if self.hours_between_refresh <= 0:
+            return 1
+        now = datetime.now(timezone.utc)
+        next_reset = (now + timedelta(days=1)).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        hours_left = (next_reset - now).total_seconds() / 3600
+        return max(1, math.ceil(hours_left / self.hours_between_refresh))
@@ -0,0 +1,140 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Adaptive rate limiter for requests to a single host.
+
+    Requests are sent without any delay while the server responds quickly. When the server
+    answers with 429 or a 5xx status, fails to answer, or responds much slower than usual,
+    the delay between requests is doubled. After every recovery_responses normal responses
+    in a row the delay is halved again, so recovering takes about as long as backing off,
+    and once max_recovery_seconds have passed without a problem the delay is back at
+    min_delay, however high it was.
+
+    Attributes:
+        delay (float): The current number of seconds between requests.
+        throttled_seconds (float): Total seconds spent waiting since the stats were last reset.
+        backoffs (int): Number of times the delay was increased since the stats were last reset.
+    """
+
+    def __init__(
+        self,
+        min_delay=0,
+        max_delay=30,
+        recovery_responses=3,
+        max_recovery_seconds=60,
+        latency_factor=3,
+        min_slow_latency=1,
+    ):
+        """
+        Args:
+            min_delay (float): Minimum seconds between requests. 0 means no throttling at all.
+            max_delay (float): Maximum seconds between requests when backing off.
+            recovery_responses (int): Normal responses in a row after which the delay is halved.
+            max_recovery_seconds (float): Seconds after the last backoff at which the delay is
+                reset to min_delay.
+            latency_factor (float): A response is slow when it takes this many times longer
+                than the average response.
+            min_slow_latency (float): Responses faster than this many seconds are never slow.
+        """
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.recovery_responses = recovery_responses
+        self.max_recovery_seconds = max_recovery_seconds
+        self.latency_factor = latency_factor
+        self.min_slow_latency = min_slow_latency
+        self.delay = min_delay
+        self.throttled_seconds = 0
+        self.backoffs = 0
+        self.__average_latency = None
+        self.__next_request_time = 0
+        self.__last_backoff_time = None
+        self.__normal_responses = 0
+        self.__lock = threading.Lock()
+
+    def wait(self):
+        """
+        Blocks until the next request may be sent. Each caller reserves its own slot
+        so concurrent callers are spaced out by the current delay as well.
+        """
+        with self.__lock:
+            now = time.monotonic()
+            wait_seconds = max(0, self.__next_request_time - now)
+            self.__next_request_time = max(now, self.__next_request_time) + self.delay
+            self.throttled_seconds += wait_seconds
+
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+    def record(self, status_code, latency, retry_after=None):
+        """
+        Adjusts the delay based on the outcome of a request.
+
+        Args:
+            status_code (int): The HTTP status code, or None if the request failed without a response.
+            latency (float): Seconds the request took.
+            retry_after (float, optional): Seconds the server asked us to wait (Retry-After header).
+        """
+        with self.__lock:
+            slow = self.__average_latency is not None and latency > max(
+                self.min_slow_latency, self.__average_latency * self.latency_factor
+            )
+
+            if status_code is None or status_code == 429 or status_code >= 500 or slow:
+                self.delay = min(self.max_delay, max(self.delay * 2, 0.5))
+                self.backoffs += 1
+                self.__last_backoff_time = time.monotonic()
+                self.__normal_responses = 0
+                if retry_after:
+                    self.__next_request_time = max(
+                        self.__next_request_time, time.monotonic() + retry_after
+                    )
+            elif self.delay > self.min_delay:
+                self.__normal_responses += 1
+                if (
+                    time.monotonic() - self.__last_backoff_time
+                    >= self.max_recovery_seconds
+                ):
+                    self.delay = self.min_delay
+                elif self.__normal_responses >= self.recovery_responses:
+                    self.__normal_responses = 0
+                    self.delay = self.delay / 2
+                    # Delays this short are not worth keeping
+                    if self.delay < max(self.min_delay, 0.05):
+                        self.delay = self.min_delay
+
+            if self.__average_latency is None:
+                self.__average_latency = latency
+            else:
+                self.__average_latency = 0.8 * self.__average_latency + 0.2 * latency
+
+    def get_stats(self, reset=False) -> dict:
+        """
+        Args:
+            reset (bool): If True, reset the counters after returning them.
+
+        Returns:
+            dict: {"throttled_seconds": float, "backoffs": int, "delay": float}
+        """
+        with self.__lock:
+            stats = {
+                "throttled_seconds": self.throttled_seconds,
+                "backoffs": self.backoffs,
+                "delay": self.delay,
+            }
+            if reset:
+                self.throttled_seconds = 0
+                self.backoffs = 0
+        return stats
+
+    @staticmethod
+    def parse_retry_after(value):
+        """
+        Returns the Retry-After header value in seconds, or None if missing or given as a date.
+        """
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
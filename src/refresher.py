@@ -1,4 +1,7 @@
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from src.db import JsonDb
 
 
 class Refresher:
@@ -6,16 +9,55 @@ class Refresher:
     A class that represents a refresher for processing collections. Helps keeping the ratings in the collections
     up to date by refreshing items that are newly added or newly premiered.
 
+    Only items added within the refresh window are requested from Emby, so the cost of a
+    collection depends on the number of recent items rather than the size of the collection.
+
+    process_collection only queues the items that are due. refresh_queued_items then refreshes
+    at most max_refreshes_per_cycle of them, most recently premiered first, with a pool of
+    workers paced by the rate limiter of the Emby instance. The rest stay due for the next cycle.
+
+    When each item was refreshed is stored in temp/refresh_schedule.json, so items are not
+    refreshed again after a restart before they are due. An item is due again
+    hours_between_refreshes after its refresh, up to twice that for items that premiered
+    longer ago, so refreshes of the same items spread out over the cycles.
+
     Attributes:
         emby (object): An instance of the Emby class.
-        seconds_between_requests (int): The number of seconds between each request.
-        processed_items (list): A list of already processed item IDs so they don't get processed again.
+        workers (int): The number of refresh requests sent at the same time.
+        hours_between_refreshes (int): Minimum hours before an item is refreshed again.
+        max_refreshes_per_cycle (int): Maximum number of refreshes per cycle, 0 for no limit.
+        refresh_profile (str): How items are refreshed, one of Emby.refresh_profiles.
+        schedule (dict): {item_id: {"last_refreshed": "2024-01-01T00:00:00Z", "next_eligible": "2024-01-02T00:00:00Z"}}
+        queued_items (dict): Items that are due, {item_id: item}.
+        refreshed_items (list): Items refreshed with show_rating_change, waiting for report_rating_changes.
     """
 
-    def __init__(self, emby):
+    date_format = "%Y-%m-%dT%H:%M:%SZ"
+    # Refreshes run in the background in Emby, see report_rating_changes
+    seconds_between_refresh_checks = 5
+    max_seconds_to_wait_for_refresh = 120
+
+    # Schedule entries of items that have not been due for this long are removed
+    schedule_retention = timedelta(days=60)
+
+    def __init__(
+        self,
+        emby,
+        workers=2,
+        hours_between_refreshes=24,
+        max_refreshes_per_cycle=100,
+        db=None,
+        refresh_profile="metadata_only",
+    ):
         self.emby = emby
-        self.seconds_between_requests = 1
-        self.processed_items = []
+        self.workers = workers
+        self.hours_between_refreshes = hours_between_refreshes
+        self.max_refreshes_per_cycle = max_refreshes_per_cycle
+        self.refresh_profile = refresh_profile
+        self.db = db if db is not None else JsonDb("refresh_schedule.json")
+        self.schedule = self.db.load(default={})
+        self.queued_items = {}
+        self.refreshed_items = []
 
     def process_collection(
         self,
@@ -25,32 +67,40 @@ class Refresher:
         show_rating_change: bool = False,
     ):
         """
-        Process a collection based on specified criteria.
+        Queues the items of a collection that are due for a refresh, see refresh_queued_items.
         Both max_days_since_added and max_days_since_premiered must be satisfied for an item to be refreshed.
 
         Args:
             collection_id (int): The ID of the emby collection to process.
             max_days_since_added (int): Will be refreshed if the item was added to Emby less than this number of days ago.
             max_days_since_premiered (int): Will be refreshed if the item premiered less than this number of days ago.
-            show_rating_change (bool): If True, will print the rating change for each item, requires an additional API request for each item.
+            show_rating_change (bool): If True, the refreshed items are kept for report_rating_changes,
+                which prints the rating change of all of them.
         """
+        current_date = datetime.now(timezone.utc).replace(tzinfo=None)
+        # Items with whole days since added <= max_days_since_added, as checked below
+        min_date_created = current_date - timedelta(days=max_days_since_added + 1)
 
+        # PremiereDate is filtered here instead of with MinPremiereDate because items
+        # without a premiere date are refreshed as if they premiered today
         items_in_collection = self.emby.get_items_in_collection(
-            collection_id, ["PremiereDate", "DateCreated", "CommunityRating"]
+            collection_id,
+            ["PremiereDate", "DateCreated", "CommunityRating", "DateLastRefreshed"],
+            params={"MinDateCreated": min_date_created.strftime(self.date_format)},
         )
 
-        current_date = datetime.now()
+        if items_in_collection is None:
+            print(f"ERROR: Could not get items in collection {collection_id}")
+            return
+
         for item in items_in_collection:
             # Example item: {'Id': '1541497', 'PremiereDate': '2023-11-08T09:27:58.0000000Z', 'DateCreated': '2023-12-08T09:27:58.0000000Z'}
-            # Check if DateCreated is less than 7 days and PremiereDate is less than 30 days
-            # Current date
 
-            if item["Id"] in self.processed_items:
-                # print(f"Item already processed: {item['Id']} {item['Name']}")
+            if item["Id"] in self.queued_items or not self.__is_due(
+                item["Id"], current_date
+            ):
                 continue
 
-            self.processed_items.append(item["Id"])
-
             created_date = None
             try:
                 created_date = datetime.fromisoformat(
@@ -80,26 +130,140 @@ class Refresher:
             days_since_premiered = (current_date - premier_date).days
 
             if days_since_premiered > max_days_since_premiered:
-                # print(f"Premiered {max_days_since_premiered} days ago: {item['Name']}")
                 continue
 
             if days_since_created > max_days_since_added:
-                # print(f"Added more than {max_days_since_added} days ago {item['Name']}")
                 continue
 
-            r = self.emby.refresh_item(item["Id"])
-            if r is True:
+            item["DaysSincePremiered"] = days_since_premiered
+            item["ShowRatingChange"] = show_rating_change
+            self.queued_items[item["Id"]] = item
+
+    def refresh_queued_items(self):
+        """
+        Refreshes the queued items, most recently premiered first, and schedules their next refresh.
+        Items over max_refreshes_per_cycle are left for the next cycle.
+        """
+        items_to_refresh = sorted(
+            self.queued_items.values(), key=lambda item: item["DaysSincePremiered"]
+        )
+        self.queued_items = {}
+        deferred_count = 0
+        if self.max_refreshes_per_cycle > 0:
+            deferred_count = max(
+                0, len(items_to_refresh) - self.max_refreshes_per_cycle
+            )
+            items_to_refresh = items_to_refresh[: self.max_refreshes_per_cycle]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            refreshed = executor.map(self.__refresh, items_to_refresh)
+            for item, success in zip(items_to_refresh, refreshed):
+                if not success:
+                    print(f"ERROR: Item refresh fail: {item['Id']} {item['Name']}")
+                    continue
                 print(f"    {item['Name']}")
-                if not show_rating_change:
+                self.__schedule_next_refresh(item)
+                if item["ShowRatingChange"]:
+                    self.refreshed_items.append(item)
+
+        if deferred_count:
+            print(
+                f"Refreshed {len(items_to_refresh)} items, {deferred_count} items are left for the next cycle"
+            )
+        self.__prune_schedule()
+        self.db.save(self.schedule)
+
+    def report_rating_changes(self):
+        """
+        Prints the rating before and after the refresh for the items refreshed with
+        show_rating_change since the last report.
+
+        Emby refreshes items in the background, so the ratings are fetched in batches
+        until DateLastRefreshed of every item has changed or max_seconds_to_wait_for_refresh
+        has passed.
+        """
+        if not self.refreshed_items:
+            return
+
+        items_by_id = {item["Id"]: item for item in self.refreshed_items}
+        self.refreshed_items = []
+        new_ratings = {}
+        pending_ids = list(items_by_id)
+        deadline = time.monotonic() + self.max_seconds_to_wait_for_refresh
+
+        print(f"\nWaiting for {len(pending_ids)} items to finish refreshing")
+        while True:
+            time.sleep(self.seconds_between_refresh_checks)
+            items = self.emby.get_items_by_ids(
+                pending_ids, ["CommunityRating", "DateLastRefreshed"]
+            )
+            if items is None:
+                print("ERROR: Could not check the refreshed items, stopped waiting")
+                break
+            for item in items:
+                if item["Id"] not in items_by_id:
                     continue
-                old_rating = item["CommunityRating"]
-                item = self.emby.get_item(item["Id"])  # Get new rating
-                if "CommunityRating" not in item:
-                    item["CommunityRating"] = 0
-                new_rating = item["CommunityRating"]
-                print(f"    Rating change {old_rating} -> {new_rating}")
-            else:
-                print(f"ERROR: Item refresh fail: {item['Id']} {item['Name']}")
+                if (
+                    item.get("DateLastRefreshed")
+                    != items_by_id[item["Id"]]["DateLastRefreshed"]
+                ):
+                    new_ratings[item["Id"]] = item.get("CommunityRating")
+            pending_ids = [
+                item_id for item_id in pending_ids if item_id not in new_ratings
+            ]
+            if not pending_ids or time.monotonic() >= deadline:
+                break
+
+        print()
+        print("Rating changes:")
+        unchanged_count = 0
+        for item_id, item in items_by_id.items():
+            if item_id not in new_ratings:
+                continue
+            old_rating = item["CommunityRating"]
+            new_rating = new_ratings[item_id]
+            if old_rating == new_rating:
+                unchanged_count += 1
+                continue
+            print(f"    {item['Name']}: {old_rating} -> {new_rating}")
+        print(
+            f"    {unchanged_count} unchanged, {len(pending_ids)} still refreshing after {self.max_seconds_to_wait_for_refresh} seconds"
+        )
+
+    def __is_due(self, item_id, now) -> bool:
+        entry = self.schedule.get(item_id)
+        return entry is None or self.__parse_date(entry["next_eligible"]) <= now
+
+    def __schedule_next_refresh(self, item: dict):
+        # Items that premiered longer ago wait up to twice as long, their ratings change less
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        age_factor = 1 + min(max(item["DaysSincePremiered"], 0), 30) / 30
+        next_eligible = now + timedelta(hours=self.hours_between_refreshes * age_factor)
+        self.schedule[item["Id"]] = {
+            "last_refreshed": now.strftime(self.date_format),
+            "next_eligible": next_eligible.strftime(self.date_format),
+        }
+
+    def __prune_schedule(self):
+        oldest = (
+            datetime.now(timezone.utc).replace(tzinfo=None) - self.schedule_retention
+        )
+        self.schedule = {
+            item_id: entry
+            for item_id, entry in self.schedule.items()
+            if self.__parse_date(entry["next_eligible"]) >= oldest
+        }
+
+    @classmethod
+    def __parse_date(cls, value):
+        return datetime.strptime(value, cls.date_format)
+
+    def __refresh(self, item: dict) -> bool:
+        try:
+            return self.emby.refresh_item(item["Id"], self.refresh_profile) is True
+        except Exception as e:
+            print(f"Error refreshing item {item['Id']}: {e}")
+            return False
 
 
 def main():
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from requests.structures import CaseInsensitiveDict
+
+
+class CachedResponse:
+    """
+    A response served from ResponseCache. Has the parts of requests.Response the
+    MDBList client uses, so callers don't need to know where a response came from.
+
+    The body stays on disk until it is read, iter_content reads it in chunks.
+    """
+
+    def __init__(self, meta: dict, body_path: str):
+        self.status_code = meta["status_code"]
+        self.headers = CaseInsensitiveDict(meta["headers"])
+        self.url = meta["url"]
+        self.body_path = body_path
+        self.stored_at = meta["stored_at"]
+        self.ok = 200 <= self.status_code < 400
+
+    @property
+    def content(self) -> bytes:
+        with open(self.body_path, "rb") as f:
+            return f.read()
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8")
+
+    def json(self):
+        with open(self.body_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def iter_content(self, chunk_size=64 * 1024):
+        with open(self.body_path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                yield chunk
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ResponseCache:
+    """
+    On-disk cache of GET responses, keyed by URL without the API key.
+
+    Each entry is a JSON file with the status, the headers and when the response was
+    stored, next to a file with the body, so large bodies never have to be held in memory.
+    Entries younger than ttl_seconds are used without asking the server. Older entries are
+    revalidated with If-None-Match and If-Modified-Since when the server sent an ETag or
+    Last-Modified header.
+    """
+
+    # Headers kept with a cached response
+    stored_headers = ["Content-Type", "ETag", "Last-Modified", "X-Has-More"]
+    # Query parameters left out of the cache key and the stored URL
+    secret_params = ["apikey"]
+
+    def __init__(
+        self, ttl_seconds=3600, cache_dir=os.path.join("temp", "mdblist_cache")
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.cache_dir = cache_dir
+        self.__lock = threading.Lock()
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def get(self, url: str):
+        """
+        Returns:
+            CachedResponse: The cached response for the URL, or None if there is none.
+        """
+        meta_path, body_path = self.__paths(url)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(body_path):
+            return None
+        return CachedResponse(meta, body_path)
+
+    def is_fresh(self, cached_response: CachedResponse) -> bool:
+        return time.time() - cached_response.stored_at < self.ttl_seconds
+
+    def validation_headers(self, cached_response: CachedResponse) -> dict:
+        # Headers that make the server answer 304 Not Modified if the body has not changed
+        headers = {}
+        if cached_response.headers.get("ETag"):
+            headers["If-None-Match"] = cached_response.headers["ETag"]
+        if cached_response.headers.get("Last-Modified"):
+            headers["If-Modified-Since"] = cached_response.headers["Last-Modified"]
+        return headers
+
+    def store(self, url: str, response) -> CachedResponse:
+        """
+        Streams the body of a requests.Response opened with stream=True to disk.
+
+        Returns:
+            CachedResponse: The stored response.
+        """
+        meta_path, body_path = self.__paths(url)
+        self.__write_atomic(body_path, response.iter_content(64 * 1024))
+        meta = {
+            "url": self.strip_secrets(url),
+            "status_code": response.status_code,
+            "headers": {
+                header: response.headers[header]
+                for header in self.stored_headers
+                if header in response.headers
+            },
+            "stored_at": time.time(),
+        }
+        self.__write_atomic(meta_path, [json.dumps(meta).encode("utf-8")])
+        return self.get(url)
+
+    def touch(self, url: str, cached_response: CachedResponse) -> CachedResponse:
+        # Marks a revalidated entry as fresh again
+        meta_path, _ = self.__paths(url)
+        meta = {
+            "url": cached_response.url,
+            "status_code": cached_response.status_code,
+            "headers": dict(cached_response.headers),
+            "stored_at": time.time(),
+        }
+        self.__write_atomic(meta_path, [json.dumps(meta).encode("utf-8")])
+        return self.get(url)
+
+    @classmethod
+    def strip_secrets(cls, url: str) -> str:
+        parts = urlsplit(url)
+        query = [
+            (key, value)
+            for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if key.lower() not in cls.secret_params
+        ]
+        return urlunsplit(parts._replace(query=urlencode(query)))
+
+    def __paths(self, url: str):
+        key = hashlib.sha256(self.strip_secrets(url).encode("utf-8")).hexdigest()
+        base_path = os.path.join(self.cache_dir, key)
+        return base_path + ".json", base_path + ".body"
+
+    def __write_atomic(self, path: str, chunks):
+        # Written to a temporary file first so readers never see a half written file
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            with self.__lock:
+                os.replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise